@@ -5,76 +5,724 @@
 Note: does not work equally well on all systems
 Simple audio library using audioalsa
 
-Demo/Test: 
-./audio_alsa.py
+A single mixer thread writes period sized chunks to the device and
+mixes all currently playing sounds (voices), so sounds can overlap.
+
+Latency is roughly `periods` * `period_size` frames. Smaller periods
+mean less latency but more wakeups and a higher risk of underruns.
+AutoTune picks the smallest period that plays without underruns on
+the current device.
+
+Sounds are loaded on first use and kept in an LRU cache limited to
+`memory_budget` bytes. Files whose format differs from the device
+format (the format of the first file, but always 16 bit) are converted
+once. With `cache_dir` the converted PCM is stored on disk keyed by
+the file's hash so later runs skip the conversion.
+
+Long files (e.g. background music) can be played with PlayStream which
+memory maps the file and releases the pages already played, so memory
+use stays small regardless of the file size. Streams are mixed with
+the other sounds. They must be in the device format.
+
+Demo/Test:
+./audio_alsa.py [long.wav]
 
 Dependencies:
-pip3 install pyalsaaudio
+pip3 install pyalsaaudio numpy   # pyalsaaudio >= 0.9
 """
 
 import alsaaudio
+import collections
+import hashlib
 import logging
+import mmap
 import os
+import struct
 import wave
 import threading
+import time
+
+import numpy
+
+# period sizes tried by AutoTune (in frames)
+AUTO_TUNE_PERIODS = [64, 128, 256, 512, 1024, 2048, 4096]
+
+# streams drop pages already played in blocks of this size
+_RELEASE_BYTES = 1 << 20
+
+
+def _FileHash(fn):
+    h = hashlib.sha1()
+    with open(fn, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 16), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _ReadPcm(w):
+    """Returns the frames of an open wave file as (frames, channels)
+    int16 array
+    """
+    width = w.getsampwidth()
+    raw = w.readframes(w.getnframes())
+    if width == 1:
+        # unsigned
+        a = (numpy.frombuffer(raw, dtype=numpy.uint8).astype(numpy.int16)
+             - 128) << 8
+    elif width == 2:
+        a = numpy.frombuffer(raw, dtype="<i2")
+    elif width == 3:
+        b = numpy.frombuffer(raw, dtype=numpy.uint8).reshape(-1, 3)
+        a = ((b[:, 2].astype(numpy.int8).astype(numpy.int32) << 8) |
+             b[:, 1]).astype(numpy.int16)
+    elif width == 4:
+        a = (numpy.frombuffer(raw, dtype="<i4") >> 16).astype(numpy.int16)
+    else:
+        raise ValueError("unsupported sample width %d" % width)
+    return a.reshape(-1, w.getnchannels())
+
+
+def _Normalize(a, rate, channels, target_rate):
+    """Converts a (frames, channels) array to `channels` and
+    `target_rate` (linear interpolation) and returns it flattened
+    """
+    if a.shape[1] != channels:
+        if channels == 1:
+            a = a.mean(axis=1, keepdims=True)
+        elif a.shape[1] == 1:
+            a = numpy.repeat(a, channels, axis=1)
+        else:
+            a = a[:, :channels]
+    if rate != target_rate:
+        n = int(round(len(a) * target_rate / rate))
+        t = numpy.arange(n) * (rate / target_rate)
+        x = numpy.arange(len(a))
+        a = numpy.stack([numpy.interp(t, x, a[:, c])
+                         for c in range(channels)], axis=1)
+    return numpy.round(a).clip(-32768, 32767).astype("<i2").reshape(-1)
+
+
+def _DataChunk(fp):
+    """Returns (offset, size, (channels, rate, width)) of the data chunk
+    of a wave file
+    """
+    riff, _, wave_id = struct.unpack("<4sI4s", fp.read(12))
+    if riff != b"RIFF" or wave_id != b"WAVE":
+        raise ValueError("not a wave file")
+    param = None
+    while True:
+        header = fp.read(8)
+        if len(header) < 8:
+            raise ValueError("no data chunk")
+        chunk_id, size = struct.unpack("<4sI", header)
+        if chunk_id == b"fmt ":
+            fmt = fp.read(size + (size & 1))
+            _, channels, rate, _, _, bits = struct.unpack("<HHIIHH", fmt[:16])
+            param = (channels, rate, bits // 8)
+        elif chunk_id == b"data":
+            if param is None:
+                raise ValueError("data chunk before fmt chunk")
+            # the size may be bogus for files still being written
+            file_size = os.fstat(fp.fileno()).st_size
+            return fp.tell(), min(size, file_size - fp.tell()), param
+        else:
+            # chunks are padded to an even size
+            fp.seek(size + (size & 1), os.SEEK_CUR)
+
+
+class _SampleCache:
+    """LRU cache of loaded samples limited to `budget` bytes"""
+
+    def __init__(self, budget, loader):
+        self._budget = budget
+        self._loader = loader
+        self._entries = collections.OrderedDict()
+        # names being loaded (without holding the lock)
+        self._loading = set()
+        self._cond = threading.Condition()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def Get(self, name):
+        with self._cond:
+            while True:
+                data = self._entries.get(name)
+                if data is not None:
+                    self._entries.move_to_end(name)
+                    self._hits += 1
+                    return data
+                if name not in self._loading:
+                    break
+                # another thread is loading it
+                self._cond.wait()
+            self._misses += 1
+            self._loading.add(name)
+        # loading may take long, do not block plays of cached sounds
+        try:
+            data = self._loader(name)
+        except BaseException:
+            with self._cond:
+                self._loading.discard(name)
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            self._loading.discard(name)
+            self._entries[name] = data
+            self._bytes += data.nbytes
+            # always keep the newest entry even if it exceeds the budget
+            while self._bytes > self._budget and len(self._entries) > 1:
+                _, old = self._entries.popitem(last=False)
+                self._bytes -= old.nbytes
+                self._evictions += 1
+            self._cond.notify_all()
+        return data
+
+    def stats(self):
+        with self._cond:
+            return {
+                "cached": len(self._entries),
+                "cached_bytes": self._bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+            }
+
+
+class _UnderrunDetector:
+    """Detects underruns of a playback device
+
+    pyalsaaudio's PCM.write recovers from underruns internally and still
+    reports all frames as written. So the PCM state is checked where
+    available (pyalsaaudio >= 0.10). Otherwise the frames written since
+    playback (re)started are compared with the wall clock: the device
+    ran dry if it should have played more than it was given.
+    It also tells how much audio is queued in the device.
+    """
+
+    def __init__(self, device, rate, period, periods):
+        self.device = device
+        self._avail = getattr(device, "avail", None)
+        self._state = getattr(device, "state", None)
+        if not hasattr(alsaaudio, "PCM_STATE_XRUN"):
+            self._state = None
+        self._rate = rate
+        self._buffer_frames = period * periods
+        self._buffer_secs = period * periods / rate
+        # tolerance for scheduling jitter
+        self._slack = 0.5 * period / rate
+        self._start = None
+        self._frames = 0
+
+    def Restart(self):
+        """Call when the device was left to drain on purpose"""
+        self._start = None
+
+    def _Queued(self, now):
+        """Estimated secs of audio in the device buffer"""
+        return self._frames / self._rate - (now - self._start)
+
+    def Queued(self, now):
+        """Secs of audio in the device buffer: from PCM.avail where
+        available (pyalsaaudio >= 0.10), otherwise estimated
+        """
+        if self._start is None:
+            return 0.0
+        if self._avail is not None:
+            try:
+                return max(0, self._buffer_frames - self._avail()) / self._rate
+            except alsaaudio.ALSAAudioError:
+                pass
+        return min(max(0.0, self._Queued(now)), self._buffer_secs)
+
+    def BeforeWrite(self, now):
+        """Returns True if the device ran dry since the last write"""
+        if self._start is None:
+            self._start = now
+            self._frames = 0
+            return False
+        if self._state is not None:
+            xrun = self._state() == alsaaudio.PCM_STATE_XRUN
+        else:
+            xrun = self._Queued(now) < -self._slack
+        if xrun:
+            # playback restarts with this write
+            self._start = now
+            self._frames = 0
+        return xrun
+
+    def AfterWrite(self, frames, write_start, now):
+        """Returns True if the device ran dry during the write, i.e. the
+        write took longer than playing what was queued before it
+        """
+        if self._frames and (now - write_start >
+                             self._Queued(write_start) + self._slack):
+            # playback restarted with this write
+            self._start = now
+            self._frames = frames
+            return True
+        self._frames += frames
+        # A write that blocked returned as soon as there was room, i.e.
+        # the buffer is full now. Resync to correct for the drift
+        # between the sound card's clock and the system clock.
+        if (now - write_start > self._slack or
+                self._Queued(now) > self._buffer_secs):
+            self._start = now - (self._frames / self._rate -
+                                 self._buffer_secs)
+        return False
+
+
+class Voice:
+    """A playing sound as returned by Audio.Play"""
+
+    def __init__(self, name, data, gain):
+        self.name = name
+        self.gain = gain
+        self._data = data
+        self.pos = 0
+        self.done = threading.Event()
+        self._stopped = False
+        self.start_time = time.time()
+        # estimated secs from Play to the first sample leaving the
+        # device buffer (see Audio.stats)
+        self.latency_estimate = None
+
+    def SetGain(self, gain):
+        self.gain = gain
+
+    def Stop(self):
+        # the mixer drops the voice with the next period
+        self._stopped = True
+
+    def Wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    def _Next(self, n):
+        """Returns the next `n` samples (fewer at the end)"""
+        chunk = self._data[self.pos:self.pos + n]
+        self.pos += len(chunk)
+        return chunk
+
+    def _Finished(self):
+        return self._stopped or self.pos >= len(self._data)
+
+    def _Done(self):
+        self.done.set()
+
+
+class StreamVoice(Voice):
+    """Voice playing straight from a memory mapped wave file"""
+
+    def __init__(self, name, filename, fmt, gain, loop):
+        with open(filename, "rb") as fp:
+            offset, size, param = _DataChunk(fp)
+            if param != fmt:
+                raise ValueError("[%s] format %s does not match device %s" %
+                                 (filename, param, fmt))
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(self._mm, "madvise"):
+            self._mm.madvise(mmap.MADV_SEQUENTIAL)
+        # assume Litte-Endian
+        data = numpy.frombuffer(self._mm, dtype="<i2", count=size // 2,
+                                offset=offset)
+        super().__init__(name, data, gain)
+        self._offset = offset
+        self._loop = loop
+        # file offset up to which pages were released
+        self._released = 0
+
+    def _Release(self, end):
+        end = end // mmap.PAGESIZE * mmap.PAGESIZE
+        if end <= self._released or not hasattr(self._mm, "madvise"):
+            return
+        self._mm.madvise(mmap.MADV_DONTNEED, self._released,
+                         end - self._released)
+        self._released = end
+
+    def _Next(self, n):
+        chunk = super()._Next(n)
+        if self._loop and len(chunk) < n and not self._stopped:
+            self._Release(len(self._mm))
+            self._released = 0
+            self.pos = 0
+            chunk = numpy.concatenate((chunk, super()._Next(n - len(chunk))))
+        end = self._offset + 2 * self.pos
+        if end - self._released >= _RELEASE_BYTES:
+            self._Release(end)
+        return chunk
+
+    def _Finished(self):
+        if self._loop:
+            return self._stopped
+        return super()._Finished()
+
+    def _Done(self):
+        # the mapping is closed when the last view is gone
+        self._data = None
+        self._mm = None
+        super()._Done()
 
 
 class Audio:
+    """
+    `period_size`: frames per device period (default: rate // 8)
+    `periods`: periods per device buffer
+    `device`: alsa device name
+    `memory_budget`: max bytes of loaded sounds
+    `cache_dir`: optional directory for converted sounds
+    """
 
-    def __init__(self, files):
+    def __init__(self, files, period_size=None, periods=4, device="default",
+                 memory_budget=32 << 20, cache_dir=None):
+        # name -> filename, loaded on demand
         self.samples = {}
         self._format = None
         self._device = None
+        self._cache_dir = cache_dir
+        self._converted = 0
         for fn in files:
             basename = os.path.basename(fn)
             key, ext = os.path.splitext(basename)
-            logging.info("loading [%s] -> [%s]" % (fn, key))
-            w = wave.open(fn, 'rb')
-            param = (w.getnchannels(), w.getframerate(), w.getsampwidth())
-            logging.info("params: %s", str(param))
-            assert w.getsampwidth() == 2
+            logging.info("adding [%s] -> [%s]" % (fn, key))
             if self._format is None:
-                self._format = param
-            elif self._format != param:
-                logging.error("incompatible wave params: %s vs %s",
-                              param, self._format)
-
-            self.samples[key] = w.readframes(w.getnframes())
+                with wave.open(fn, 'rb') as w:
+                    self._format = (w.getnchannels(), w.getframerate(), 2)
+                logging.info("device params: %s", str(self._format))
+            self.samples[key] = fn
+        self._cache = _SampleCache(memory_budget, self._Load)
+        self._voices = []
+        self._cond = threading.Condition()
+        self._closing = False
+        self._mixer = None
+        self._periods = 0
+        self._underruns = 0
+        self._device_errors = 0
+        self._late = 0
+        self._mix_time = 0.0
+        self._mix_time_max = 0.0
+        self._played = 0
+        self._latency_sum = 0.0
+        self._latency_max = 0.0
+        self._latency_count = 0
+        self._device_name = device
+        self._periods_per_buffer = periods
+        self._period = period_size
         if self._format:
-            self._device = alsaaudio.PCM(
-                type=alsaaudio.PCM_PLAYBACK, device="default")
-            self._device.setchannels(param[0])
-            self._device.setrate(param[1])
-            self._device.setperiodsize(param[1] // 8)
-            # assume Litte-Endian
-            self._device.setformat(alsaaudio.PCM_FORMAT_S16_LE)
+            if self._period is None:
+                self._period = self._format[1] // 8
+            self._device = self._OpenDevice(self._period)
+            self._mixer = threading.Thread(target=self._Mixer, daemon=True)
+            self._mixer.start()
+
+    def _OpenDevice(self, period):
+        channels, rate, _ = self._format
+        # assume Litte-Endian
+        return alsaaudio.PCM(
+            type=alsaaudio.PCM_PLAYBACK, device=self._device_name,
+            channels=channels, rate=rate, format=alsaaudio.PCM_FORMAT_S16_LE,
+            periodsize=period, periods=self._periods_per_buffer)
 
     def Names(self):
         return self.samples.keys()
 
-    def _PlayHelper(self, period, s):
-        # TODO: consider writing in period chunks rather than everything a once
-        self._device.write(s)
+    def _Load(self, name):
+        fn = self.samples[name]
+        logging.info("loading [%s]", fn)
+        with wave.open(fn, 'rb') as w:
+            param = (w.getnchannels(), w.getframerate(), w.getsampwidth())
+            if param == self._format:
+                # assume Litte-Endian
+                return numpy.frombuffer(w.readframes(w.getnframes()),
+                                        dtype="<i2")
+            channels, rate, _ = self._format
+            cache_file = None
+            if self._cache_dir is not None:
+                cache_file = os.path.join(self._cache_dir, "%s-%d-%d.s16" % (
+                    _FileHash(fn), channels, rate))
+                if os.path.exists(cache_file):
+                    return numpy.fromfile(cache_file, dtype="<i2")
+            logging.info("converting [%s] %s -> %s", fn, param, self._format)
+            data = _Normalize(_ReadPcm(w), param[1], channels, rate)
+        self._converted += 1
+        if cache_file is not None:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            tmp = cache_file + ".tmp"
+            data.tofile(tmp)
+            os.replace(tmp, cache_file)
+        return data
+
+    def Preload(self, names):
+        """Load sounds up front (as far as the memory budget permits)"""
+        for name in names:
+            self._cache.Get(name)
+
+    def _MixPeriod(self, voices, acc):
+        acc[:] = 0
+        for v in voices:
+            if v._stopped:
+                continue
+            chunk = v._Next(len(acc))
+            if v.gain == 1.0:
+                acc[:len(chunk)] += chunk
+            elif v.gain:
+                acc[:len(chunk)] += (chunk * v.gain).astype(numpy.int32)
+        # saturate rather than wrap around
+        numpy.clip(acc, -32768, 32767, out=acc)
+        return acc.astype("<i2").tobytes()
+
+    def _RecordLatency(self, voices, now, ahead_secs):
+        for v in voices:
+            if v.latency_estimate is not None:
+                continue
+            v.latency_estimate = max(0.0, now - v.start_time) + ahead_secs
+            self._latency_sum += v.latency_estimate
+            self._latency_max = max(self._latency_max, v.latency_estimate)
+            self._latency_count += 1
+
+    def _EndVoices(self):
+        # needs self._cond, wakes up blocking Play and Voice.Wait
+        for v in self._voices:
+            v._Done()
+        self._voices.clear()
+
+    def _DeviceFailed(self, device):
+        """Ends all voices and reopens the device. Returns False if
+        that is not possible and the mixer has to stop.
+        """
+        self._device_errors += 1
+        with self._cond:
+            self._EndVoices()
+            if self._closing or self._device is not device:
+                # closed or replaced by AutoTune meanwhile
+                return not self._closing
+            try:
+                device.close()
+            except alsaaudio.ALSAAudioError:
+                pass
+            try:
+                self._device = self._OpenDevice(self._period)
+            except alsaaudio.ALSAAudioError:
+                logging.exception("cannot reopen audio device")
+                self._device = None
+                self._closing = True
+                return False
+        logging.info("audio device reopened")
+        return True
+
+    def _Mixer(self):
+        channels, rate, _ = self._format
+        idle = True
+        detector = None
+        while True:
+            with self._cond:
+                while not self._voices and not self._closing:
+                    idle = True
+                    self._cond.wait()
+                if self._closing:
+                    self._EndVoices()
+                    return
+                voices = list(self._voices)
+                # AutoTune may have changed it
+                period = self._period
+                device = self._device
+            if detector is None or detector.device is not device:
+                detector = _UnderrunDetector(device, rate, period,
+                                             self._periods_per_buffer)
+            period_secs = period / rate
+            acc = numpy.zeros(period * channels, dtype=numpy.int32)
+            start = time.time()
+            out = self._MixPeriod(voices, acc)
+            mix_time = time.time() - start
+            self._mix_time += mix_time
+            self._mix_time_max = max(self._mix_time_max, mix_time)
+            if mix_time > period_secs:
+                self._late += 1
+            if idle:
+                detector.Restart()
+            idle = False
+            write_start = time.time()
+            if detector.BeforeWrite(write_start):
+                self._underruns += 1
+            try:
+                # blocks until the device has room for the period
+                device.write(out)
+            except alsaaudio.ALSAAudioError:
+                logging.exception("audio device write failed")
+                if not self._DeviceFailed(device):
+                    return
+                idle = True
+                continue
+            now = time.time()
+            if detector.AfterWrite(period, write_start, now):
+                self._underruns += 1
+            # new voices start playing after what is queued ahead of
+            # the period just written
+            self._RecordLatency(voices, now,
+                                max(0.0, detector.Queued(now) - period_secs))
+            self._periods += 1
+            finished = [v for v in voices if v._Finished()]
+            if finished:
+                with self._cond:
+                    for v in finished:
+                        self._voices.remove(v)
+                        v._Done()
 
-    def Play(self, name, blocking=False):
-        s = self.samples[name]
+    def Play(self, name, blocking=False, gain=1.0):
+        """Starts playing a sound (mixed with those already playing)
+        and returns its Voice which can be used to stop it or to
+        change its gain.
+        """
+        return self._Start(Voice(name, self._cache.Get(name), gain), blocking)
+
+    def PlayStream(self, filename, blocking=False, gain=1.0, loop=False):
+        """Like Play but streams `filename` from disk (the file must be
+        in the device format). With `loop` it plays until stopped.
+        """
+        voice = StreamVoice(os.path.basename(filename), filename,
+                            self._format, gain, loop)
+        return self._Start(voice, blocking)
+
+    def _Start(self, voice, blocking):
+        with self._cond:
+            if self._closing:
+                # closed or the device is gone
+                voice._Done()
+                return voice
+            self._voices.append(voice)
+            self._played += 1
+            self._cond.notify()
         if blocking:
-            self._PlayHelper(0, s)
-        else:
-            threading.Thread(target=self._PlayHelper, args=(0, s)).start()
+            voice.Wait()
+        return voice
+
+    def _Probe(self, device, period, secs, load):
+        """Plays silence for `secs` while mixing `load` voices and
+        returns the number of underruns
+        """
+        channels, rate, _ = self._format
+        acc = numpy.zeros(period * channels, dtype=numpy.int32)
+        silence = numpy.zeros(int(secs * rate) * channels, dtype=numpy.int16)
+        voices = [Voice("probe", silence, 0.5) for _ in range(load)]
+        detector = _UnderrunDetector(device, rate, period,
+                                     self._periods_per_buffer)
+        underruns = 0
+        for _ in range(int(secs * rate) // period):
+            out = self._MixPeriod(voices, acc)
+            start = time.time()
+            if detector.BeforeWrite(start):
+                underruns += 1
+            device.write(out)
+            if detector.AfterWrite(period, start, time.time()):
+                underruns += 1
+        return underruns
+
+    def AutoTune(self, candidates=AUTO_TUNE_PERIODS, secs=1.0, load=4):
+        """Switch to the smallest period size from `candidates` that
+        plays `secs` without underruns while mixing `load` voices.
+        Call this before playing sounds. Returns the period size.
+        """
+        with self._cond:
+            if self._device is not None:
+                self._device.close()
+            best = max(candidates)
+            for period in sorted(candidates):
+                try:
+                    device = self._OpenDevice(period)
+                except alsaaudio.ALSAAudioError as err:
+                    logging.info("period %d not supported: %s", period, err)
+                    continue
+                underruns = self._Probe(device, period, secs, load)
+                device.close()
+                logging.info("period %d underruns %d", period, underruns)
+                if underruns == 0:
+                    best = period
+                    break
+            self._period = best
+            self._device = self._OpenDevice(best)
+        return best
+
+    def StopAll(self):
+        with self._cond:
+            for v in self._voices:
+                v.Stop()
+
+    def Close(self):
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        if self._mixer is not None:
+            self._mixer.join()
+        with self._cond:
+            # in case the mixer died
+            self._EndVoices()
+        if self._device is not None:
+            self._device.close()
+
+    def stats(self):
+        """The latency is an estimate: the time from Play until the
+        voice is mixed plus the audio queued ahead of it in the device
+        buffer (exact with PCM.avail). Delays after the buffer (e.g.
+        in the codec) are not included.
+        """
+        with self._cond:
+            active = len(self._voices)
+        out = self._cache.stats()
+        out["converted"] = self._converted
+        out.update({
+            "voices_active": active,
+            "voices_played": self._played,
+            "periods": self._periods,
+            "underruns": self._underruns,
+            "device_errors": self._device_errors,
+            "late_periods": self._late,
+            "mix_time": self._mix_time,
+            "mix_time_max": self._mix_time_max,
+            "mix_time_avg": (self._mix_time / self._periods
+                             if self._periods else 0.0),
+            "period_size": self._period,
+            "buffer_size": self._period * self._periods_per_buffer,
+            "latency_estimate_avg": (self._latency_sum / self._latency_count
+                                     if self._latency_count else 0.0),
+            "latency_estimate_max": self._latency_max,
+        })
+        return out
 
 
 if __name__ == "__main__":
-    import time
     import glob
+    import random
+    import sys
 
     def main():
         logging.basicConfig(level=logging.INFO)
         cwd = os.path.dirname(__file__)
         audio = Audio(glob.glob(cwd + "/Sounds/*.wav"))
+        logging.info("auto tuned period size: %d", audio.AutoTune())
         for n in audio.Names():
             logging.info("play %s" % n)
             audio.Play(n, True)
             time.sleep(2.0)
+        # all sounds overlapping, the first one at half volume
+        voices = [audio.Play(n, gain=0.5 if i == 0 else 1.0)
+                  for i, n in enumerate(audio.Names())]
+        for v in voices:
+            v.Wait()
+        logging.info("stats %s", audio.stats())
+        if len(sys.argv) > 1:
+            # e.g. a long ambient track with effects on top
+            stream = audio.PlayStream(sys.argv[1], gain=0.5)
+            while not stream.Wait(1.0):
+                audio.Play(random.choice(list(audio.Names())))
+            logging.info("stats %s", audio.stats())
+        # a blocking Play racing with Close returns, later ones at once
+        name = next(iter(audio.Names()))
+        player = threading.Thread(target=audio.Play, args=(name, True))
+        player.start()
+        time.sleep(0.05)
+        audio.Close()
+        player.join(5.0)
+        assert not player.is_alive(), "blocking Play hangs after Close"
+        assert audio.Play(name, True).done.is_set()
 
     main()
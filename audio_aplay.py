@@ -4,7 +4,13 @@
 """
 Simple audio library using the external aplay binary
 
-Demo/Test: 
+Instead of starting aplay for every sound a small pool of long lived
+aplay processes per sample format is fed raw PCM over stdin.
+Each process plays one sound at a time, so `workers` sounds of the
+same format can overlap. Plays that do not fit into the bounded
+queue are dropped (and counted).
+
+Demo/Test:
 ./audio_aplay.py Sounds/*
 
 Dependencies
@@ -14,11 +20,200 @@ sudo apt install alsa-utils
 
 import logging
 import os
+import queue
+import subprocess
+import threading
+import time
+import wave
+
+# sample width in bytes -> aplay format
+_APLAY_FORMATS = {1: "U8", 2: "S16_LE", 3: "S24_3LE", 4: "S32_LE"}
+
+
+class _Sound(object):
+
+    def __init__(self, param, data):
+        # (channels, rate, width)
+        self.param = param
+        self.data = data
+        self.secs = len(data) / (param[0] * param[1] * param[2])
+
+
+class _Request(object):
+
+    def __init__(self, sound):
+        self.sound = sound
+        self.time = time.time()
+        self.done = threading.Event()
+
+
+class _Worker(object):
+    """One aplay process plus the thread feeding it"""
+
+    def __init__(self, pool, param, period_frames, buffer_periods):
+        self._pool = pool
+        channels, rate, width = param
+        self._silence_byte = b"\x80" if width == 1 else b"\0"
+        # aplay only plays complete periods
+        self._period_bytes = period_frames * channels * width
+        self._args = [
+            "aplay", "-q", "-t", "raw", "-f", _APLAY_FORMATS[width],
+            "-c", str(channels), "-r", str(rate),
+            "--period-size=%d" % period_frames,
+            "--buffer-size=%d" % (period_frames * buffer_periods),
+            # start playing as soon as there is any data
+            "--start-delay=1",
+        ]
+        self._proc = None
+        # start aplay right away so that no play pays for its startup
+        self._Start()
+        self._thread = threading.Thread(target=self._Run, daemon=True)
+        self._thread.start()
+
+    def _Start(self):
+        if self._proc is not None:
+            # died or stuck
+            self._proc.kill()
+            try:
+                self._proc.stdin.close()
+            except OSError:
+                pass
+            self._proc.wait()
+            self._proc = None
+        logging.info("starting %s", self._args)
+        try:
+            self._proc = subprocess.Popen(self._args, stdin=subprocess.PIPE,
+                                          stderr=subprocess.DEVNULL)
+        except OSError:
+            logging.exception("cannot start aplay")
+
+    def _Pad(self, data):
+        rest = len(data) % self._period_bytes
+        if rest == 0:
+            return data
+        return data + self._silence_byte * (self._period_bytes - rest)
+
+    def _Run(self):
+        while True:
+            req = self._pool.Next()
+            if req is None:
+                break
+            start = time.time()
+            self._pool.Started(req, start)
+            if self._proc is None:
+                # starting failed before, try again
+                self._Start()
+            if self._proc is None:
+                self._pool.Error()
+                req.done.set()
+                continue
+            try:
+                self._proc.stdin.write(self._Pad(req.sound.data))
+                self._proc.stdin.flush()
+            except OSError:
+                logging.exception("aplay failed")
+                self._pool.Error()
+                self._Start()
+                req.done.set()
+                continue
+            # the pipe and alsa buffers absorb the data long before it is
+            # played - stay busy until the sound is over so the next one
+            # goes to an idle worker and can overlap
+            remaining = start + req.sound.secs - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+            req.done.set()
+            if self._proc.poll() is not None:
+                # restart now rather than on the next play
+                logging.warning("aplay exited")
+                self._pool.Error()
+                self._Start()
+        if self._proc is not None:
+            self._proc.stdin.close()
+            self._proc.wait()
+
+    def Join(self):
+        self._thread.join()
+
+
+class _Pool(object):
+    """The aplay workers for one sample format"""
+
+    def __init__(self, param, workers, queue_len, period_frames,
+                 buffer_periods):
+        self._queue = queue.Queue(maxsize=queue_len)
+        self._num_workers = workers
+        # protects the stats below, they are updated by all workers
+        self._lock = threading.Lock()
+        self.plays = 0
+        self.dropped = 0
+        self.errors = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self._workers = [_Worker(self, param, period_frames, buffer_periods)
+                         for _ in range(workers)]
+
+    def Put(self, req):
+        try:
+            self._queue.put_nowait(req)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            req.done.set()
+            return False
+        return True
+
+    def Next(self):
+        return self._queue.get()
+
+    def Started(self, req, now):
+        latency = now - req.time
+        with self._lock:
+            self.plays += 1
+            self.latency_sum += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    def Error(self):
+        with self._lock:
+            self.errors += 1
+
+    def Stats(self):
+        with self._lock:
+            return {
+                "plays": self.plays,
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "latency_avg": (self.latency_sum / self.plays
+                                if self.plays else 0.0),
+                "latency_max": self.latency_max,
+            }
+
+    def Close(self):
+        for _ in self._workers:
+            self._queue.put(None)
+        for w in self._workers:
+            w.Join()
 
 
 class Audio(object):
-    def __init__(self, files):
+    """
+    `workers`: aplay processes per sample format, i.e. max number of
+        overlapping sounds of the same format
+    `queue_len`: max number of waiting plays per format
+    `period_frames`, `buffer_periods`: aplay buffer configuration, the
+        latency is about `period_frames` * `buffer_periods` frames
+    """
+
+    def __init__(self, files, workers=2, queue_len=8, period_frames=512,
+                 buffer_periods=4):
         self.samples = {}
+        self._sounds = {}
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._workers = workers
+        self._queue_len = queue_len
+        self._period_frames = period_frames
+        self._buffer_periods = buffer_periods
         for fn in files:
             basename = os.path.basename(fn)
             key, ext = os.path.splitext(basename)
@@ -28,17 +223,57 @@ class Audio(object):
     def Names(self):
         return self.samples.keys()
 
-    def Play(self, name, blocking):
-        s = self.samples[name]
-        logging.info("playing [%s]" % s)
+    def _Sound(self, name):
+        sound = self._sounds.get(name)
+        if sound is None:
+            with wave.open(self.samples[name], "rb") as w:
+                param = (w.getnchannels(), w.getframerate(),
+                         w.getsampwidth())
+                sound = _Sound(param, w.readframes(w.getnframes()))
+            self._sounds[name] = sound
+        return sound
+
+    def _Pool(self, param):
+        pool = self._pools.get(param)
+        if pool is None:
+            pool = _Pool(param, self._workers, self._queue_len,
+                         self._period_frames, self._buffer_periods)
+            self._pools[param] = pool
+        return pool
+
+    def Play(self, name, blocking=False):
+        """Returns False if the play was dropped because too many plays
+        are waiting
+        """
+        with self._lock:
+            sound = self._Sound(name)
+            pool = self._Pool(sound.param)
+        logging.info("playing [%s]" % self.samples[name])
+        req = _Request(sound)
+        ok = pool.Put(req)
         if blocking:
-            os.system("aplay '%s'" % s)
-        else:
-            os.spawnlp(os.P_NOWAIT, "aplay", "aplay", s)
+            req.done.wait()
+        return ok
+
+    def Close(self):
+        with self._lock:
+            for pool in self._pools.values():
+                pool.Close()
+            self._pools.clear()
+
+    def stats(self):
+        """Latency is from Play until the sound is handed to aplay
+        (add the aplay buffer time for the audible latency)
+        """
+        out = {}
+        with self._lock:
+            for param, pool in self._pools.items():
+                out["%dch %dHz %dbit" % (param[0], param[1],
+                                         8 * param[2])] = pool.Stats()
+        return out
 
 
 if __name__ == "__main__":
-    import time
     import glob
 
     def main():
@@ -49,5 +284,12 @@ if __name__ == "__main__":
             logging.info("play %s" % n)
             audio.Play(n, True)
             time.sleep(1.0)
+        # overlapping
+        for n in audio.Names():
+            audio.Play(n)
+            time.sleep(0.2)
+        time.sleep(3.0)
+        logging.info("stats %s", audio.stats())
+        audio.Close()
 
     main()
@@ -3,37 +3,218 @@
 
 """Simple audio library using simpleaudio
 
-Demo/Test: 
+Sounds are loaded on first use and kept in an LRU cache limited to
+`memory_budget` bytes.
+If `device_format` (channels, rate) is given, files in other formats
+are converted once (always to 16 bit). With `cache_dir` the converted
+PCM is stored on disk keyed by the file's hash so later runs skip the
+conversion.
+
+Demo/Test:
 ./audio_simple.py
 
 Dependencies:
 pip3 install simpleaudio
+pip3 install numpy  # only for `device_format`
 """
 
 
+import collections
+import hashlib
 import logging
 import os
+import threading
+import wave
+
 import simpleaudio
 
+# numpy is only needed for converting sounds to `device_format`
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _FileHash(fn):
+    h = hashlib.sha1()
+    with open(fn, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 16), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _ReadPcm(w):
+    """Returns the frames of an open wave file as (frames, channels)
+    int16 array
+    """
+    width = w.getsampwidth()
+    raw = w.readframes(w.getnframes())
+    if width == 1:
+        # unsigned
+        a = (numpy.frombuffer(raw, dtype=numpy.uint8).astype(numpy.int16)
+             - 128) << 8
+    elif width == 2:
+        a = numpy.frombuffer(raw, dtype="<i2")
+    elif width == 3:
+        b = numpy.frombuffer(raw, dtype=numpy.uint8).reshape(-1, 3)
+        a = ((b[:, 2].astype(numpy.int8).astype(numpy.int32) << 8) |
+             b[:, 1]).astype(numpy.int16)
+    elif width == 4:
+        a = (numpy.frombuffer(raw, dtype="<i4") >> 16).astype(numpy.int16)
+    else:
+        raise ValueError("unsupported sample width %d" % width)
+    return a.reshape(-1, w.getnchannels())
+
+
+def _Normalize(a, rate, channels, target_rate):
+    """Converts a (frames, channels) array to `channels` and
+    `target_rate` (linear interpolation) and returns it flattened
+    """
+    if a.shape[1] != channels:
+        if channels == 1:
+            a = a.mean(axis=1, keepdims=True)
+        elif a.shape[1] == 1:
+            a = numpy.repeat(a, channels, axis=1)
+        else:
+            a = a[:, :channels]
+    if rate != target_rate:
+        n = int(round(len(a) * target_rate / rate))
+        t = numpy.arange(n) * (rate / target_rate)
+        x = numpy.arange(len(a))
+        a = numpy.stack([numpy.interp(t, x, a[:, c])
+                         for c in range(channels)], axis=1)
+    return numpy.round(a).clip(-32768, 32767).astype("<i2").reshape(-1)
+
+
+class _SampleCache:
+    """LRU cache of WaveObjects limited to `budget` bytes"""
+
+    def __init__(self, budget, loader):
+        self._budget = budget
+        self._loader = loader
+        self._entries = collections.OrderedDict()
+        # names being loaded (without holding the lock)
+        self._loading = set()
+        self._cond = threading.Condition()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def Get(self, name):
+        with self._cond:
+            while True:
+                obj = self._entries.get(name)
+                if obj is not None:
+                    self._entries.move_to_end(name)
+                    self._hits += 1
+                    return obj
+                if name not in self._loading:
+                    break
+                # another thread is loading it
+                self._cond.wait()
+            self._misses += 1
+            self._loading.add(name)
+        # loading may take long, do not block plays of cached sounds
+        try:
+            obj = self._loader(name)
+        except BaseException:
+            with self._cond:
+                self._loading.discard(name)
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            self._loading.discard(name)
+            self._entries[name] = obj
+            self._bytes += len(obj.audio_data)
+            # always keep the newest entry even if it exceeds the budget
+            while self._bytes > self._budget and len(self._entries) > 1:
+                _, old = self._entries.popitem(last=False)
+                self._bytes -= len(old.audio_data)
+                self._evictions += 1
+            self._cond.notify_all()
+        return obj
+
+    def stats(self):
+        with self._cond:
+            return {
+                "cached": len(self._entries),
+                "cached_bytes": self._bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+            }
+
 
 class Audio:
+    """
+    `memory_budget`: max bytes of loaded sounds
+    `device_format`: optional (channels, rate) all sounds are converted to
+    `cache_dir`: optional directory for converted sounds
+    """
 
-    def __init__(self, files):
+    def __init__(self, files, memory_budget=32 << 20, device_format=None,
+                 cache_dir=None):
+        # name -> filename, loaded on demand
         self.samples = {}
+        self._format = device_format
+        self._cache_dir = cache_dir
+        self._converted = 0
         for fn in files:
             basename = os.path.basename(fn)
             key, ext = os.path.splitext(basename)
-            logging.info("loading [%s] -> [%s]" % (fn, key))
-            self.samples[key] = simpleaudio.WaveObject.from_wave_file(fn)
+            logging.info("adding [%s] -> [%s]" % (fn, key))
+            self.samples[key] = fn
+        self._cache = _SampleCache(memory_budget, self._Load)
 
     def Names(self):
         return self.samples.keys()
 
+    def _Load(self, name):
+        fn = self.samples[name]
+        logging.info("loading [%s]", fn)
+        if self._format is None:
+            return simpleaudio.WaveObject.from_wave_file(fn)
+        channels, rate = self._format
+        with wave.open(fn, 'rb') as w:
+            param = (w.getnchannels(), w.getframerate(), w.getsampwidth())
+            if param == (channels, rate, 2):
+                return simpleaudio.WaveObject(w.readframes(w.getnframes()),
+                                              channels, 2, rate)
+            cache_file = None
+            if self._cache_dir is not None:
+                cache_file = os.path.join(self._cache_dir, "%s-%d-%d.s16" % (
+                    _FileHash(fn), channels, rate))
+                if os.path.exists(cache_file):
+                    with open(cache_file, "rb") as fp:
+                        return simpleaudio.WaveObject(fp.read(), channels, 2,
+                                                      rate)
+            logging.info("converting [%s] %s -> %s", fn, param, self._format)
+            data = _Normalize(_ReadPcm(w), param[1], channels, rate).tobytes()
+        self._converted += 1
+        if cache_file is not None:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            tmp = cache_file + ".tmp"
+            with open(tmp, "wb") as fp:
+                fp.write(data)
+            os.replace(tmp, cache_file)
+        return simpleaudio.WaveObject(data, channels, 2, rate)
+
+    def Preload(self, names):
+        """Load sounds up front (as far as the memory budget permits)"""
+        for name in names:
+            self._cache.Get(name)
+
     def Play(self, name, blocking=False):
-        p = self.samples[name].play()
+        p = self._cache.Get(name).play()
         if blocking:
             p.wait_done()
 
+    def stats(self):
+        out = self._cache.stats()
+        out["converted"] = self._converted
+        return out
+
 
 if __name__ == "__main__":
     import time
@@ -47,5 +228,6 @@ if __name__ == "__main__":
             logging.info("play %s" % n)
             audio.Play(n, True)
             time.sleep(2.0)
+        logging.info("stats %s", audio.stats())
 
     main()
@@ -2,12 +2,34 @@
 # cf.: https://github.com/BoschSensortec/BME280_driver/
 #      https://cdn.sparkfun.com/assets/learn_tutorials/4/1/9/BST-BME280_DS001-10.pdf
 
-import smbus
+import array
+import logging
 import time
 import struct
 import threading
 
+# optional: only needed for the *Batch functions
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# smbus2 is preferred: only it allows combined multi register reads
+# in one transaction (python-smbus has no i2c_rdwr)
+try:
+    import smbus2 as smbus
+    from smbus2 import i2c_msg
+except ImportError:
+    import smbus
+    i2c_msg = None
+
 # Operating Modes
+BME280_MODE_SLEEP = 0
+BME280_MODE_FORCED = 1
+BME280_MODE_NORMAL = 3
+
+# Oversampling Settings
+BME280_OSAMPLE_SKIP = 0
 BME280_OSAMPLE_1 = 1
 BME280_OSAMPLE_2 = 2
 BME280_OSAMPLE_4 = 3
@@ -31,6 +53,29 @@ BME280_FILTER_4 = 2
 BME280_FILTER_8 = 3
 BME280_FILTER_16 = 4
 
+# number of samples for each oversampling setting (0 = skipped)
+_OSAMPLE_COUNT = [0, 1, 2, 4, 8, 16]
+
+# standby duration in secs for each standby setting
+_STANDBY_SECS = [0.0005, 0.0625, 0.125, 0.25, 0.5, 1.0, 0.010, 0.020]
+
+# Recommended settings from section 3.5 of the datasheet.
+# Use with SetMode(device, **PRESETS[name]) or SensorBME280(settings=...)
+PRESETS = {
+    # one measurement per minute (or less), lowest power
+    "weather": dict(mode=BME280_MODE_FORCED, hmode=BME280_OSAMPLE_1,
+                    pmode=BME280_OSAMPLE_1, tmode=BME280_OSAMPLE_1,
+                    filter=BME280_FILTER_OFF),
+    # low noise pressure, ~25 Hz output
+    "indoor": dict(mode=BME280_MODE_NORMAL, hmode=BME280_OSAMPLE_1,
+                   pmode=BME280_OSAMPLE_16, tmode=BME280_OSAMPLE_2,
+                   standby=BME280_STANDBY_0p5, filter=BME280_FILTER_16),
+    # fast pressure changes, ~80 Hz output, no humidity
+    "high rate": dict(mode=BME280_MODE_NORMAL, hmode=BME280_OSAMPLE_SKIP,
+                      pmode=BME280_OSAMPLE_4, tmode=BME280_OSAMPLE_1,
+                      standby=BME280_STANDBY_0p5, filter=BME280_FILTER_16),
+}
+
 BME280_REGISTER_DIG_T1 = 0x88
 BME280_REGISTER_DIG_P1 = 0x8E
 BME280_REGISTER_DIG_H1 = 0xA1
@@ -50,31 +95,83 @@ MAGIC_BMP280 = 0x58
 MAGIC_BME280 = 0x60
 
 
-def SetMode(device, hmode=BME280_OSAMPLE_1, pmode=BME280_OSAMPLE_1, tmode=BME280_OSAMPLE_1,
-            standby=BME280_STANDBY_250, filter=BME280_FILTER_OFF):
-    device.write(BME280_REGISTER_CONTROL_HUM, [hmode])
-    time.sleep(0.002)
+def MeasurementTime(hmode=BME280_OSAMPLE_1, pmode=BME280_OSAMPLE_1, tmode=BME280_OSAMPLE_1):
+    """Max duration of one measurement in secs (datasheet appendix B)"""
+    t = 1.25 + 2.3 * _OSAMPLE_COUNT[tmode]
+    if pmode:
+        t += 2.3 * _OSAMPLE_COUNT[pmode] + 0.575
+    if hmode:
+        t += 2.3 * _OSAMPLE_COUNT[hmode] + 0.575
+    return t / 1000.0
 
-    device.write(BME280_REGISTER_CONFIG, [(standby << 5) | (filter << 2)])
-    time.sleep(0.002)
 
-    # Select Control measurement register, 0xF4(244)
-    device.write(BME280_REGISTER_CONTROL, [(tmode << 5) | (pmode << 2) | 3])
-    time.sleep(0.002)
+def _PairData(pairs):
+    """The bme280 does not auto increment the register on writes but
+    accepts register/value pairs instead. Returns the first register
+    and the data for writing all (register, value) `pairs` in one block.
+    """
+    first_register, first_value = pairs[0]
+    data = [first_value]
+    for register, value in pairs[1:]:
+        data += [register, value]
+    return first_register, data
 
 
-def ReadRawMeasurements(device):
-    # wait for data to become available
-    while (device.read(BME280_REGISTER_STATUS, 1)[0] & 0x08):
-        print("#####")
-        time.sleep(0.002)
+def _WriteRegisters(device, pairs):
+    if hasattr(device, "write_registers"):
+        device.write_registers(pairs)
+    else:
+        # a plain block write, e.g. i2c_bus.I2CDevice
+        device.write(*_PairData(pairs))
+
+
+def _ReadRegions(device, regions):
+    if hasattr(device, "read_regions"):
+        return device.read_regions(regions)
+    return [device.read(register, length) for register, length in regions]
 
+
+def CycleTime(hmode=BME280_OSAMPLE_1, pmode=BME280_OSAMPLE_1, tmode=BME280_OSAMPLE_1,
+              standby=BME280_STANDBY_250):
+    """Max time between measurements in normal mode in secs - the
+    sensor usually runs faster (typical rather than max conversion times)
+    """
+    return MeasurementTime(hmode, pmode, tmode) + _STANDBY_SECS[standby]
+
+
+def SetMode(device, hmode=BME280_OSAMPLE_1, pmode=BME280_OSAMPLE_1, tmode=BME280_OSAMPLE_1,
+            standby=BME280_STANDBY_250, filter=BME280_FILTER_OFF, mode=BME280_MODE_NORMAL):
+    # config writes may be ignored in normal mode, so go to sleep first
+    # ctrl_hum only takes effect after the write to ctrl_meas
+    _WriteRegisters(device, [
+        (BME280_REGISTER_CONTROL, BME280_MODE_SLEEP),
+        (BME280_REGISTER_CONTROL_HUM, hmode),
+        (BME280_REGISTER_CONFIG, (standby << 5) | (filter << 2)),
+        # Select Control measurement register, 0xF4(244)
+        (BME280_REGISTER_CONTROL, (tmode << 5) | (pmode << 2) | mode),
+    ])
+    if mode != BME280_MODE_SLEEP:
+        # wait for the first measurement to complete, after that the
+        # data registers always hold a complete (shadowed) measurement
+        time.sleep(MeasurementTime(hmode, pmode, tmode))
+
+
+def TriggerMeasurement(device, pmode=BME280_OSAMPLE_1, tmode=BME280_OSAMPLE_1):
+    """Start a single measurement in forced mode. The sensor returns
+    to sleep mode when done. Wait for MeasurementTime before reading.
+    The humidity oversampling from SetMode is retained.
+    """
+    device.write(BME280_REGISTER_CONTROL,
+                 [(tmode << 5) | (pmode << 2) | BME280_MODE_FORCED])
+
+
+def ReadRawMeasurements(device):
     # Read data back from 0xF7(247), 8 bytes
     data = device.read(BME280_REGISTER_DATA, 8)
 
     # Convert pressure and temperature data to 19-bits
-    adc_p = (data[0] * 65536 + data[1] * 256 + (data[2] & 0xF0)) / 16
-    adc_t = (data[3] * 65536 + data[4] * 256 + (data[5] & 0xF0)) / 16
+    adc_p = (data[0] * 65536 + data[1] * 256 + (data[2] & 0xF0)) // 16
+    adc_t = (data[3] * 65536 + data[4] * 256 + (data[5] & 0xF0)) // 16
 
     # Convert the humidity data
     adc_h = data[6] * 256 + data[7]
@@ -121,18 +218,16 @@ def ComputeHumidity(adc_h, t_fine, hcal):
 
 
 def ReadCalibrationData(device):
-    # Read data back from 0x88(136), 24 bytes
-    buf = device.read(BME280_REGISTER_DIG_T1, 6)
-    tcal = struct.unpack("<Hhh", bytes(buf))
-
-    buf = device.read(BME280_REGISTER_DIG_P1, 18)
-    pcal = struct.unpack("<Hhhhhhhhh", bytes(buf))
+    # Read data back from 0x88(136) - 0xA1(161), 26 bytes
+    # and from 0xE1(225), 7 bytes
+    buf, b1 = _ReadRegions(device, [
+        (BME280_REGISTER_DIG_T1, BME280_REGISTER_DIG_H1 - BME280_REGISTER_DIG_T1 + 1),
+        (BME280_REGISTER_DIG_H2, 7)])
+    tcal = struct.unpack_from("<Hhh", bytes(buf), 0)
+    pcal = struct.unpack_from(
+        "<Hhhhhhhhh", bytes(buf), BME280_REGISTER_DIG_P1 - BME280_REGISTER_DIG_T1)
+    h1 = buf[BME280_REGISTER_DIG_H1 - BME280_REGISTER_DIG_T1]
 
-    # Read data back from 0xA1(161), 1 byte
-    h1 = device.read(BME280_REGISTER_DIG_H1, 1)[0]
-
-    # Read data back from 0xE1(225), 7 bytes
-    b1 = device.read(BME280_REGISTER_DIG_H2, 7)
     # h2, h3, h4, h5, h6 = struct.unpack("<hBh", bytes(b1))
 
     # Convert the data
@@ -170,37 +265,289 @@ def ReadMeasurements(device, hcal, pcal, tcal):
     return temp, pressure, humidity
 
 
+# Integer versions of the compensation formulas from the datasheet
+# (section 4.2.3) for targets without an FPU.
+# Temperature and humidity use 32 bit, pressure 64 bit math.
+def ComputeTempInt(adc_t, tcal):
+    """Returns t_fine"""
+    t1, t2, t3 = tcal
+    var1 = (((adc_t >> 3) - (t1 << 1)) * t2) >> 11
+    var2 = ((((adc_t >> 4) - t1) * ((adc_t >> 4) - t1)) >> 12) * t3 >> 14
+    return var1 + var2
+
+
+def ComputePressureInt(adc_p, t_fine, pcal):
+    """Returns pressure in Pa as Q24.8 fixed point"""
+    p1, p2, p3, p4, p5, p6, p7, p8, p9 = pcal
+    var1 = t_fine - 128000
+    var2 = var1 * var1 * p6
+    var2 = var2 + ((var1 * p5) << 17)
+    var2 = var2 + (p4 << 35)
+    var1 = ((var1 * var1 * p3) >> 8) + ((var1 * p2) << 12)
+    var1 = (((1 << 47) + var1) * p1) >> 33
+    if var1 == 0:
+        return 0
+    p = 1048576 - adc_p
+    p = ((p << 31) - var2) * 3125
+    # C division truncates towards zero
+    p = p // var1 if (p >= 0) == (var1 > 0) else -(-p // var1)
+    var1 = (p9 * (p >> 13) * (p >> 13)) >> 25
+    var2 = (p8 * p) >> 19
+    return ((p + var1 + var2) >> 8) + (p7 << 4)
+
+
+def ComputeHumidityInt(adc_h, t_fine, hcal):
+    """Returns humidity in %RH as Q22.10 fixed point"""
+    h1, h2, h3, h4, h5, h6 = hcal
+    v = t_fine - 76800
+    v = ((((adc_h << 14) - (h4 << 20) - (h5 * v)) + 16384) >> 15) * (
+        ((((((v * h6) >> 10) * (((v * h3) >> 11) + 32768)) >> 10) + 2097152) * h2 + 8192) >> 14)
+    v = v - (((((v >> 15) * (v >> 15)) >> 7) * h1) >> 4)
+    if v < 0:
+        v = 0
+    elif v > 419430400:
+        v = 419430400
+    return v >> 12
+
+
+def ReadMeasurementsInt(device, hcal, pcal, tcal):
+    """Like ReadMeasurements but using integer math"""
+    adc_h, adc_p, adc_t = ReadRawMeasurements(device)
+    t_fine = ComputeTempInt(adc_t, tcal)
+    temp = ((t_fine * 5 + 128) >> 8) / 100
+    pressure = ComputePressureInt(adc_p, t_fine, pcal) / 25600
+    humidity = ComputeHumidityInt(adc_h, t_fine, hcal) / 1024
+    return temp, pressure, humidity
+
+
+# The *Batch functions compensate whole arrays of raw samples at once
+# using the same formulas as their scalar counterparts
+def ComputeTempBatch(adc_t, tcal):
+    return ComputeTemp(numpy.asarray(adc_t, dtype=numpy.float64), tcal)
+
+
+def ComputePressureBatch(adc_p, t_fine, pcal):
+    return ComputePressure(numpy.asarray(adc_p, dtype=numpy.float64), t_fine, pcal)
+
+
+def ComputeHumidityBatch(adc_h, t_fine, hcal):
+    h1, h2, h3, h4, h5, h6 = hcal
+    adc_h = numpy.asarray(adc_h, dtype=numpy.float64)
+    var_H = (t_fine - 76800.0)
+    var_H = (adc_h - (h4 * 64.0 + h5 / 16384.0 * var_H)) * (
+        h2 / 65536.0 * (1.0 + h6 / 67108864.0 * var_H * (1.0 + h3 / 67108864.0 * var_H)))
+    humidity = var_H * (1.0 - h1 * var_H / 524288.0)
+    return numpy.clip(humidity, 0.0, 100.0)
+
+
+def ComputeMeasurementsBatch(adc_h, adc_p, adc_t, hcal, pcal, tcal):
+    """Array version of ReadMeasurements for logged raw samples
+    as returned by ReadRawMeasurements.
+    Returns arrays of temp, pressure and humidity.
+    """
+    t_fine = ComputeTempBatch(adc_t, tcal)
+    temp = t_fine / 5120.0
+    pressure = ComputePressureBatch(adc_p, t_fine, pcal)
+    humidity = ComputeHumidityBatch(adc_h, t_fine, hcal)
+    return temp, pressure, humidity
+
+
+class _History:
+    """Preallocated ring buffer of timestamped (temp, pressure, humidity)
+    samples. Not thread safe - the owner must lock.
+    """
+
+    def __init__(self, capacity):
+        assert capacity > 0
+        self._capacity = capacity
+        self._columns = [array.array("d", [0.0]) * capacity for _ in range(4)]
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def Add(self, *sample):
+        for column, value in zip(self._columns, sample):
+            column[self._next] = value
+        self._next = (self._next + 1) % self._capacity
+        self._count = min(self._count + 1, self._capacity)
+
+    def Window(self, since):
+        """Returns all samples with timestamp >= since, oldest first"""
+        ts, temp, pressure, humidity = self._columns
+        out = []
+        i = self._next
+        for _ in range(self._count):
+            i = (i - 1) % self._capacity
+            if ts[i] < since:
+                break
+            out.append((ts[i], temp[i], pressure[i], humidity[i]))
+        out.reverse()
+        return out
+
+
+def _Slope(xs, ys):
+    # least squares fit
+    n = len(xs)
+    mx = sum(xs) / n
+    my = sum(ys) / n
+    var = sum((x - mx) * (x - mx) for x in xs)
+    if var == 0.0:
+        return 0.0
+    return sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / var
+
+
 # This also supports BMP280 (the humidity will read as 0.0)
 class SensorBME280:
-
-    def __init__(self, device, addr=0x76, interval=60):
+    """
+    Measurements are taken by a single background sampler thread
+    every `interval` secs (started on first use of ReadMeasurements or
+    explicitly via Start) and the last `history` samples are kept.
+    `sampler`: if False ReadMeasurements does not start the sampler,
+    use this when Update is called externally, e.g. by
+    i2c_bus.I2CBus.AddPoll
+    The Read/query methods never touch the i2c bus except for
+    ReadMeasurementsFresh.
+    `integer_math`: use the integer compensation formulas which are
+    much faster on targets without an FPU
+    `settings`: SetMode parameters, e.g. one of the PRESETS.
+    In forced mode every update triggers a measurement and waits for it.
+    In normal mode the sensor's clock drifts against the host's so reads
+    are not aligned with conversions. A read during a conversion returns
+    the previous (complete) measurement as the data registers are
+    shadowed during the burst read.
+    """
+
+    def __init__(self, device, addr=0x76, interval=60, history=1024, integer_math=False,
+                 settings=None, sampler=True):
         self._device = device
         self._addr = addr
         assert device.read(BME280_REGISTER_CHIPID, 1)[
             0] in [MAGIC_BME280, MAGIC_BMP280]
         self._interval = interval
+        self._auto_start = sampler
+        self._read = ReadMeasurementsInt if integer_math else ReadMeasurements
         self._hcal, self._pcal, self._tcal = ReadCalibrationData(device)
-        SetMode(device)
+        settings = dict(settings or {})
+        self._forced = settings.get("mode") == BME280_MODE_FORCED
+        self._pmode = settings.get("pmode", BME280_OSAMPLE_1)
+        self._tmode = settings.get("tmode", BME280_OSAMPLE_1)
+        self._measure_time = MeasurementTime(
+            settings.get("hmode", BME280_OSAMPLE_1), self._pmode, self._tmode)
+        SetMode(device, **settings)
+        # protects the fields below, never held during i2c transfers
+        self._lock = threading.Lock()
+        # serializes i2c transfers
+        self._device_lock = threading.Lock()
         self._last = 0
         self._temp = None
         self._pressure = None
         self._humidity = None
+        self._history = _History(history)
+        self._sample_stats = None
+        self._sampler = None
+        self._stop = threading.Event()
         self.Update()
 
     def Update(self):
-        print("update")
-        self._last = time.time()
-        self._temp, self._pressure, self._humidity = ReadMeasurements(
-            self._device, self._hcal, self._pcal, self._tcal)
+        with self._device_lock:
+            before = self._DeviceStats()
+            if self._forced:
+                TriggerMeasurement(self._device, self._pmode, self._tmode)
+                time.sleep(self._measure_time)
+            last = time.time()
+            temp, pressure, humidity = self._read(
+                self._device, self._hcal, self._pcal, self._tcal)
+            after = self._DeviceStats()
+        with self._lock:
+            if before is not None:
+                self._sample_stats = {k: after[k] - before[k] for k in after}
+            self._last = last
+            self._temp, self._pressure, self._humidity = temp, pressure, humidity
+            self._history.Add(last, temp, pressure, humidity)
+
+    def _DeviceStats(self):
+        stats = getattr(self._device, "stats", None)
+        return stats() if stats else None
+
+    def SampleStats(self):
+        """Bus transactions, bytes and time used by the last sample
+        (None if the device does not provide stats)
+        """
+        with self._lock:
+            return self._sample_stats
+
+    def _Sampler(self):
+        due = time.time() + self._interval
+        while not self._stop.wait(max(0.0, due - time.time())):
+            try:
+                self.Update()
+            except Exception:
+                logging.exception("bme280 update failed")
+            due = max(due + self._interval, time.time())
+
+    def Start(self, interval=None):
+        """Start the background sampler (if not already running)"""
+        if interval is not None:
+            self._interval = interval
+        with self._lock:
+            if self._sampler is not None:
+                return
+            self._stop.clear()
+            self._sampler = threading.Thread(target=self._Sampler, daemon=True)
+            self._sampler.start()
+
+    def Stop(self):
+        with self._lock:
+            sampler = self._sampler
+            self._sampler = None
+        if sampler is not None:
+            self._stop.set()
+            sampler.join()
 
     def ReadMeasurements(self):
-        if self._last + self._interval < time.time():
-            threading.Thread(target=self.Update).start()
-        return self._temp, self._pressure, self._humidity
+        if self._sampler is None and self._auto_start:
+            self.Start()
+        with self._lock:
+            return self._temp, self._pressure, self._humidity
 
     def ReadMeasurementsFresh(self):
         self.Update()
-        return self._temp, self._pressure, self._humidity
+        with self._lock:
+            return self._temp, self._pressure, self._humidity
+
+    def Latest(self):
+        """Returns (timestamp, temp, pressure, humidity) of the last sample"""
+        with self._lock:
+            return self._last, self._temp, self._pressure, self._humidity
+
+    def History(self, secs):
+        """Returns the (timestamp, temp, pressure, humidity) samples
+        of the last `secs` seconds, oldest first
+        """
+        with self._lock:
+            return self._history.Window(self._last - secs)
+
+    def WindowStats(self, secs):
+        """Returns (min, max, mean) for each of temp, pressure, humidity
+        over the last `secs` seconds
+        """
+        samples = self.History(secs)
+        out = []
+        for column in list(zip(*samples))[1:]:
+            out.append((min(column), max(column), sum(column) / len(column)))
+        return tuple(out)
+
+    def RateOfChange(self, secs):
+        """Returns the change per second for each of temp, pressure,
+        humidity over the last `secs` seconds (least squares fit)
+        """
+        samples = self.History(secs)
+        if len(samples) < 2:
+            return 0.0, 0.0, 0.0
+        columns = list(zip(*samples))
+        return tuple(_Slope(columns[0], c) for c in columns[1:])
 
     def RenderMeasurements(self):
         return "%.1f\u00B0C %.0f hPa %.1f%%" % self.ReadMeasurements()
@@ -213,21 +560,65 @@ class I2CDevice:
         self._bus = smbus.SMBus(bus_no)
         self._addr = addr
         self._debug = debug
+        self._transactions = 0
+        self._bytes = 0
+        self._bus_time = 0.0
+
+    def _Account(self, start, num_bytes):
+        self._transactions += 1
+        self._bytes += num_bytes
+        self._bus_time += time.time() - start
 
     def read(self, register, length):
         """Returns an array of 'length' bytes from the 'register'"""
+        start = time.time()
         result = self._bus.read_i2c_block_data(self._addr, register, length)
+        self._Account(start, length + 1)
         if self._debug:
             print("\t(0x%02x => %s)" % (register, [hex(i) for i in result]))
         return result
 
+    def read_regions(self, regions):
+        """Returns a list of byte arrays one for each (register, length)
+        in `regions`. Uses a single combined transaction if available.
+        """
+        if i2c_msg is None or not hasattr(self._bus, "i2c_rdwr"):
+            return [self.read(register, length) for register, length in regions]
+        msgs = []
+        for register, length in regions:
+            msgs.append(i2c_msg.write(self._addr, [register]))
+            msgs.append(i2c_msg.read(self._addr, length))
+        start = time.time()
+        self._bus.i2c_rdwr(*msgs)
+        self._Account(start, sum(length + 1 for _, length in regions))
+        result = [list(m) for m in msgs[1::2]]
+        if self._debug:
+            for (register, _), r in zip(regions, result):
+                print("\t(0x%02x => %s)" % (register, [hex(i) for i in r]))
+        return result
+
+    def write_registers(self, pairs):
+        """Writes a list of (register, value) pairs in a single transaction"""
+        first_register, data = _PairData(pairs)
+        start = time.time()
+        self._bus.write_i2c_block_data(self._addr, first_register, data)
+        self._Account(start, len(data) + 1)
+        if self._debug:
+            print("\t(%s)" %
+                  ", ".join("0x%02x <= 0x%02x" % p for p in pairs))
+
     def write(self, register, values):
         """Writes an array of 'length' bytes to the 'register'"""
-        for i, value in enumerate(values):
-            self._bus.write_byte_data(self._addr, register + i, value)
-        if self._debug:
-            print("\t(0x%02x <= %s)" %
-                  (register, [hex(i) for i in values[0:]]))
+        self.write_registers([(register + i, value)
+                              for i, value in enumerate(values)])
+
+    def stats(self):
+        """Totals since creation: transactions, bytes and secs spent on the bus"""
+        return {
+            "transactions": self._transactions,
+            "bytes": self._bytes,
+            "bus_time": self._bus_time,
+        }
 
 
 if __name__ == "__main__":
@@ -252,24 +643,100 @@ if __name__ == "__main__":
         def write(self, register, values):
             pass
 
-    def test():
-        device = FakeDevice(
+    def make_test_device():
+        return FakeDevice(
             (0xd0, [0x60]),
-            (0x88, [0xd9, 0x6e, 0x5d, 0x68, 0x32, 0x00]),
-            (0x8e, [0xfa, 0x8c, 0xb8, 0xd6, 0xd0, 0xb, 0x4f, 0x17,
+            (0x88, [0xd9, 0x6e, 0x5d, 0x68, 0x32, 0x00,
+                    # 0x8e
+                    0xfa, 0x8c, 0xb8, 0xd6, 0xd0, 0xb, 0x4f, 0x17,
                     0xec, 0xff, 0xf9, 0xff, 0x0c, 0x30, 0x20, 0xd1,
-                    0x88, 0x13]),
-            (0xa1, [0x4b]),
+                    0x88, 0x13,
+                    # 0xa0 (unused), 0xa1
+                    0x00, 0x4b]),
             (0xe1, [0x49, 0x01, 0x00, 0x19, 0x2a, 0x03, 0x1e]),
-            (0xf3, [0x0]),
             (0xf7, [0x59, 0x6f, 0x0, 0x80, 0x51, 0x0, 0x7f, 0x4b]))
 
-        sensor = SensorBME280(device)
+    def test():
+        sensor = SensorBME280(make_test_device())
         temp, pressure, humidity = sensor.ReadMeasurements()
         print("TEST", temp, pressure, humidity)
         assert is_almost_equal(temp, 22.79161)
         assert is_almost_equal(pressure, 1012.05817)
         assert is_almost_equal(humidity, 31.66425)
+        sensor.Stop()
+
+        # driven externally, e.g. by i2c_bus.I2CBus.AddPoll
+        sensor = SensorBME280(make_test_device(), sampler=False)
+        assert sensor.ReadMeasurements() == (temp, pressure, humidity)
+        assert sensor._sampler is None
+
+        if numpy is not None:
+            raw = ReadRawMeasurements(FakeDevice(
+                (0xf7, [0x59, 0x6f, 0x0, 0x80, 0x51, 0x0, 0x7f, 0x4b])))
+            batch = ComputeMeasurementsBatch(
+                [raw[0]] * 3, [raw[1]] * 3, [raw[2]] * 3,
+                sensor._hcal, sensor._pcal, sensor._tcal)
+            for values, expected in zip(batch, (temp, pressure, humidity)):
+                assert all(is_almost_equal(v, expected, 1e-9) for v in values)
+
+    def benchmark_batch(n=100000):
+        if numpy is None:
+            print("numpy not available - skipping batch benchmark")
+            return
+        hcal = (75, 329, 0, 402, 50, 30)
+        pcal = (36090, -10568, 3024, 5967, -20, -7, 12300, -12000, 5000)
+        tcal = (28377, 26717, 50)
+        rng = numpy.random.default_rng(0)
+        adc_h = rng.integers(25000, 35000, n)
+        adc_p = rng.integers(350000, 370000, n)
+        adc_t = rng.integers(520000, 530000, n)
+
+        start = time.time()
+        for h, p, t in zip(adc_h.tolist(), adc_p.tolist(), adc_t.tolist()):
+            t_fine = ComputeTemp(t, tcal)
+            ComputePressure(p, t_fine, pcal)
+            ComputeHumidity(h, t_fine, hcal)
+        scalar = time.time() - start
+
+        start = time.time()
+        ComputeMeasurementsBatch(adc_h, adc_p, adc_t, hcal, pcal, tcal)
+        batch = time.time() - start
+        print("samples: %d scalar: %.0f samples/s batch: %.0f samples/s" %
+              (n, n / scalar, n / batch))
+
+    def test_int():
+        sensor = SensorBME280(make_test_device(), integer_math=True)
+        temp, pressure, humidity = sensor.ReadMeasurements()
+        print("TEST INT", temp, pressure, humidity)
+        assert is_almost_equal(temp, 22.79161, 0.01)
+        assert is_almost_equal(pressure, 1012.05817, 0.01)
+        assert is_almost_equal(humidity, 31.66425, 0.01)
+        sensor.Stop()
+
+    def benchmark_int(n=100000):
+        hcal = (75, 329, 0, 402, 50, 30)
+        pcal = (36090, -10568, 3024, 5967, -20, -7, 12300, -12000, 5000)
+        tcal = (28377, 26717, 50)
+        for name, temp_fun, pressure_fun, humidity_fun in [
+            ("float", ComputeTemp, ComputePressure, ComputeHumidity),
+            ("int", ComputeTempInt, ComputePressureInt, ComputeHumidityInt),
+        ]:
+            start = time.time()
+            for i in range(n):
+                t_fine = temp_fun(520000 + i % 10000, tcal)
+                pressure_fun(350000 + i % 20000, t_fine, pcal)
+                humidity_fun(25000 + i % 10000, t_fine, hcal)
+            stop = time.time()
+            print("%-5s compensation: %.0f samples/s" % (name, n / (stop - start)))
+
+    def test_history():
+        history = _History(4)
+        for i in range(6):
+            history.Add(float(i), 20.0 + i, 1000.0 - i, 50.0)
+        assert len(history) == 4
+        assert [s[0] for s in history.Window(0.0)] == [2.0, 3.0, 4.0, 5.0]
+        assert [s[1] for s in history.Window(4.0)] == [24.0, 25.0]
+        assert is_almost_equal(_Slope([2.0, 3.0, 4.0, 5.0], [1.0, 3.0, 5.0, 7.0]), 2.0)
 
     def main():
         device = I2CDevice(addr=0x76, debug=True)
@@ -279,6 +746,11 @@ if __name__ == "__main__":
         print("Temperature in Celsius : %.2f C" % temp)
         print("Pressure : %.2f hPa " % pressure)
         print("Relative Humidity : %.2f %%" % humidity)
+        print("Bus usage per sample: %s" % sensor.SampleStats())
 
     test()
+    test_int()
+    test_history()
+    benchmark_batch()
+    benchmark_int()
     main()
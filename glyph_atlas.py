@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Pre-rasterized glyph atlas for fast text rendering into Images
+
+ImageDraw.text with a TrueType font rasterizes every glyph on every
+call which is slow on small machines like the Pi Zero.
+GlyphAtlas rasterizes a font/size/charset once and then just blits
+glyph bitmaps. The output is meant to be pixel identical to
+ImageDraw.text with the basic layout (pair kerning, no ligatures or
+other shaping of the raqm layout).
+
+The atlas can be passed as `font` to menu.py.
+
+Demo/Test/Benchmark:
+./glyph_atlas.py
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+from PIL import Image, ImageDraw, PngImagePlugin
+
+DEFAULT_CHARSET = "".join(chr(c) for c in range(32, 127)) + "°"
+
+_ATLAS_VERSION = 3
+
+
+def _Pixels(v):
+    """26.6 fixed point -> pixels, rounded like PIL does"""
+    return (v + 32) >> 6
+
+
+class _Rasterizer(object):
+    """Rasterizes single glyphs and recovers the metrics ImageDraw.text
+    places them with.
+
+    PIL positions each glyph at its rounded pen position plus the
+    FreeType bitmap_left/top of the glyph and then shifts the whole
+    string by the difference between the glyph bitmap boxes and the
+    outline boxes (they differ by rounding, most of all in mode "1").
+    PIL does not expose bitmap_left/top so they are recovered from
+    probe strings rendered at a known origin.
+    """
+
+    def __init__(self, font, mode):
+        self._font = font
+        self._mode = mode
+        size = getattr(font, "size", 16)
+        self._origin = 4 * size + 8
+        self._step = 2 * size + 2
+        self._bar_ink = self._Ink("|")
+        # "_" is the reference for the vertical probe, it must lie
+        # below the baseline so that it does not move the string itself
+        self._under_top = None
+        ink = self._Ink("_")
+        if ink is not None and font.getbbox("_", mode, anchor="ls")[1] >= 0:
+            self._under_top = ink[1]
+        self._under_w = max(1, self.Advance("_") >> 6)
+
+    def Advance(self, text):
+        """Pen advance in 26.6 fixed point"""
+        return round(self._font.getlength(text, self._mode) * 64)
+
+    def _Render(self, text):
+        o = self._origin
+        img = Image.new(self._mode, (2 * o + self._step * len(text), 2 * o))
+        ImageDraw.Draw(img).text((o, o), text, fill="white",
+                                 font=self._font, anchor="ls")
+        return img
+
+    def _Ink(self, text, x0=None, x1=None):
+        """Ink bbox of `text` relative to the pen origin, optionally
+        only of the columns from `x0` to `x1`
+        """
+        o = self._origin
+        img = self._Render(text)
+        w, h = img.size
+        left = 0 if x0 is None else o + x0
+        img = img.crop((left, 0, w if x1 is None else o + x1, h))
+        box = img.getbbox()
+        if box is None:
+            return None
+        return (box[0] + left - o, box[1] - o, box[2] + left - o, box[3] - o)
+
+    def _BitmapTop(self, c, n):
+        """Returns the top of the string's bitmap box of `c` if it is
+        above the baseline (else 0): the "_" at the end of c + "_" * n
+        moves by it.
+        """
+        if self._under_top is None:
+            return None
+        text = c + "_" * n
+        ink = self._Ink(text, _Pixels(self.Advance(text[:-2])))
+        if ink is None:
+            return None
+        top = max(0, -self._font.getbbox(c, self._mode, anchor="ls")[1])
+        return top + ink[1] - self._under_top
+
+    def Glyph(self, c):
+        """Returns the glyph ink (or None) and a tuple of
+        (ink_x, ink_y, advance, bitmap_left, bitmap_top) + outline box
+        """
+        font = self._font
+        advance = self.Advance(c)
+        box = font.getbbox(c, self._mode, anchor="ls")
+        n = 3 + (box[2] - box[0]) // self._under_w
+        top = self._BitmapTop(c, n)
+        ink = self._Ink(c)
+        if ink is None:
+            # no ink but the bitmap box still counts for the string
+            left = 0
+            with_bar = self._Ink(c + "|")
+            if with_bar is not None:
+                pen = _Pixels(self.Advance(c + "|") - self.Advance("|"))
+                left = min(0, box[0] + pen + self._bar_ink[0] - with_bar[0])
+            if top is None:
+                # mono bitmap boxes are at least one pixel
+                top = 1 if self._mode == "1" else 0
+            return None, (0, 0, advance, left, top) + box
+        o = self._origin
+        img = self._Render(c).crop((o + ink[0], o + ink[1],
+                                    o + ink[2], o + ink[3]))
+        # Alone the glyph is shifted if it extends left of the pen, so
+        # its offset is taken behind a space. The "|" far right keeps
+        # the string box from clipping glyphs below the baseline.
+        pre = " " + c + " " * n
+        behind = self._Ink(pre + "|", x1=_Pixels(self.Advance(pre)))
+        alone = ink[0] - box[0]
+        ink_x = alone
+        if behind is not None and behind[2] - behind[0] == img.size[0]:
+            ink_x = behind[0] - _Pixels(self.Advance(" "))
+        left = ink_x if ink_x == alone else ink_x - alone
+        if top is None or top <= 0:
+            # below the baseline, alone it is not moved
+            top = -ink[1] - max(0, -box[1])
+        ink_y = ink[1] + max(0, -box[1]) - max(0, top)
+        return img, (ink_x, ink_y, advance, left, top) + box
+
+
+def _CacheName(font, charset, mode):
+    path = getattr(font, "path", None)
+    if not isinstance(path, str):
+        return None
+    key = "%d %s %s %d %s %s" % (_ATLAS_VERSION, path, os.path.getmtime(path),
+                                 font.size, mode, charset)
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    base, _ = os.path.splitext(os.path.basename(path))
+    return "%s-%d-%s-%s.png" % (base, font.size, mode, digest)
+
+
+class GlyphAtlas(object):
+    """Pre-rasterized font
+
+    `font`: a PIL font (usually ImageFont.truetype)
+    `charset`: characters to rasterize up front - others are rasterized
+        on first use
+    `mode`: "1" or "L" - must match the mode of the target images
+    `cache_dir`: if set, the atlas is stored there and reloaded on
+        the next run (only for fonts loaded from a file)
+
+    All glyphs are stored in a single strip image together with a
+    table of (strip_x, w, h, ink_x, ink_y, advance, bitmap_left,
+    bitmap_top, box_x0, box_y0, box_x1, box_y1), see _Rasterizer.
+    """
+
+    def __init__(self, font, charset=DEFAULT_CHARSET, mode="1", cache_dir=None):
+        assert mode in ("1", "L")
+        self._font = font
+        self._mode = mode
+        self._rasterizer = _Rasterizer(font, mode)
+        self._ascent = font.getmetrics()[0]
+        self._glyphs = {}
+        self._kerning = {}
+        self.size = getattr(font, "size", 0)
+        cache_file = None
+        if cache_dir is not None:
+            name = _CacheName(font, charset, mode)
+            if name is not None:
+                cache_file = os.path.join(cache_dir, name)
+        loaded = None
+        if cache_file is not None and os.path.exists(cache_file):
+            logging.info("loading glyph atlas [%s]", cache_file)
+            loaded = self._Load(cache_file)
+        if loaded is not None:
+            strip, table = loaded
+        else:
+            strip, table = self._Build(charset)
+            if cache_file is not None:
+                logging.info("saving glyph atlas [%s]", cache_file)
+                self._Save(cache_file, strip, table)
+        self._Unpack(strip, table)
+
+    def _Build(self, charset):
+        rasterized = [(c,) + self._rasterizer.Glyph(c) for c in charset]
+        w = sum(img.size[0] for _, img, _ in rasterized if img is not None)
+        h = max([img.size[1] for _, img, _ in rasterized
+                 if img is not None], default=1)
+        strip = Image.new(self._mode, (max(1, w), h))
+        table = {}
+        x = 0
+        for c, img, metrics in rasterized:
+            if img is None:
+                table[c] = (0, 0, 0) + metrics
+                continue
+            strip.paste(img, (x, 0))
+            table[c] = (x,) + img.size + metrics
+            x += img.size[0]
+        return strip, table
+
+    def _Save(self, filename, strip, table):
+        info = PngImagePlugin.PngInfo()
+        info.add_text("atlas", json.dumps(
+            {"version": _ATLAS_VERSION, "glyphs": table}))
+        tmp = filename + ".tmp"
+        strip.save(tmp, format="PNG", pnginfo=info)
+        os.replace(tmp, filename)
+
+    def _Load(self, filename):
+        # anything unexpected is just a cache miss
+        try:
+            strip = Image.open(filename)
+            strip.load()
+            meta = json.loads(strip.text["atlas"])
+            if meta["version"] != _ATLAS_VERSION:
+                raise ValueError("version %s" % meta["version"])
+            return strip.convert(self._mode), meta["glyphs"]
+        except (OSError, KeyError, ValueError) as err:
+            logging.warning("ignoring glyph atlas [%s]: %s", filename, err)
+            return None
+
+    def _Unpack(self, strip, table):
+        # one small mask image per glyph so blitting needs no cropping
+        for c, (x, w, h, *metrics) in table.items():
+            img = strip.crop((x, 0, x + w, h)) if w else None
+            self._glyphs[c] = (img, *metrics)
+
+    def _Glyph(self, c):
+        g = self._glyphs.get(c)
+        if g is None:
+            img, metrics = self._rasterizer.Glyph(c)
+            g = (img,) + metrics
+            self._glyphs[c] = g
+        return g
+
+    def _Kerning(self, a, b):
+        k = self._kerning.get((a, b))
+        if k is None:
+            r = self._rasterizer
+            k = r.Advance(a + b) - r.Advance(a) - r.Advance(b)
+            self._kerning[(a, b)] = k
+        return k
+
+    def _Layout(self, text):
+        """Returns the glyphs with their pen positions, the shift of
+        the glyph bitmaps and the text box (relative to the baseline)
+        like PIL computes them
+        """
+        glyphs = []
+        pen = 0
+        prev = None
+        x0 = y0 = x1 = y1 = 0
+        left = top = 0
+        for c in text:
+            if prev is not None:
+                pen += self._Kerning(prev, c)
+            g = self._Glyph(c)
+            px = _Pixels(pen)
+            glyphs.append((g, px))
+            _, _, _, advance, g_left, g_top, bx0, by0, bx1, by1 = g
+            x0 = min(x0, bx0 + px)
+            y0 = min(y0, by0)
+            x1 = max(x1, bx1 + px)
+            y1 = max(y1, by1)
+            left = min(left, g_left + px)
+            top = max(top, g_top)
+            pen += advance
+            prev = c
+        x1 = max(x1, _Pixels(pen))
+        return glyphs, pen, (x0 - left, y0 + top), (x0, y0, x1, y1)
+
+    def getlength(self, text):
+        return self._Layout(text)[1] / 64
+
+    def getbbox(self, text):
+        """Same convention as ImageFont.FreeTypeFont.getbbox"""
+        x0, y0, x1, y1 = self._Layout(text)[3]
+        return x0, self._ascent + y0, x1, self._ascent + y1
+
+    def blit(self, image: Image, xy, text, fill=255):
+        """Draw `text` into `image` with its top left at `xy` (like
+        ImageDraw.text with the default anchor)
+        """
+        glyphs, _, (dx, dy), box = self._Layout(text)
+        x, y = xy
+        y += self._ascent
+        # PIL clips the glyphs to the text box
+        clip = (x + box[0], y + box[1], x + box[2], y + box[3])
+        x += dx
+        y += dy
+        for (img, ink_x, ink_y, *_), px in glyphs:
+            if img is None:
+                continue
+            gx = x + px + ink_x
+            gy = y + ink_y
+            w, h = img.size
+            rect = (max(gx, clip[0]), max(gy, clip[1]),
+                    min(gx + w, clip[2]), min(gy + h, clip[3]))
+            if rect[0] >= rect[2] or rect[1] >= rect[3]:
+                continue
+            if rect != (gx, gy, gx + w, gy + h):
+                img = img.crop((rect[0] - gx, rect[1] - gy,
+                                rect[2] - gx, rect[3] - gy))
+            image.paste(fill, rect, img)
+
+    def stats(self):
+        return {
+            "glyphs": len(self._glyphs),
+            "kerning_pairs": len(self._kerning),
+            "bytes": sum(len(g[0].tobytes()) for g in self._glyphs.values()
+                         if g[0] is not None),
+        }
+
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+    import time
+
+    from PIL import ImageFont
+
+    def ImgToAscii(img: Image) -> str:
+        w, h = img.size
+        data = img.getdata()
+        out = []
+        for n, x in enumerate(data):
+            if n % w == 0:
+                out.append("")
+            out[-1] += "*" if x else " "
+        return "\n".join(out)
+
+    def main():
+        logging.basicConfig(level=logging.INFO)
+        cwd = os.path.dirname(__file__)
+        font_h = 16
+        font = ImageFont.truetype(cwd + "/Fonts/code2000.ttf", font_h)
+        cache_dir = tempfile.gettempdir()
+
+        start = time.time()
+        atlas = GlyphAtlas(font, cache_dir=cache_dir)
+        print("atlas creation msec: %.1f" % (1000.0 * (time.time() - start)))
+        start = time.time()
+        atlas = GlyphAtlas(font, cache_dir=cache_dir)
+        print("atlas load msec: %.1f" % (1000.0 * (time.time() - start)))
+
+        samples = sys.argv[1:] or [
+            "22.8°C 1012 hPa", "Hello World", "_Fly away_", " (j) {|} ",
+            "AVATAR Wolf", DEFAULT_CHARSET]
+        for text in samples:
+            w = int(font.getlength(text)) + 4
+            a = Image.new("1", (w, font_h * 2))
+            ImageDraw.Draw(a).text((1, 0), text, fill="white", font=font)
+            b = Image.new("1", (w, font_h * 2))
+            atlas.blit(b, (1, 0), text)
+            # must be identical to ImageDraw.text
+            assert a.tobytes() == b.tobytes(), text
+            assert atlas.getbbox(text) == font.getbbox(text, "1"), text
+            if text == samples[0]:
+                print(ImgToAscii(b))
+        print("atlas stats", atlas.stats())
+
+        text = samples[0]
+        w = int(font.getlength(text)) + 2
+        rounds = 1000
+        for name, fun in [
+            ("ImageDraw.text", lambda img: ImageDraw.Draw(img).text(
+                (1, 0), text, fill="white", font=font)),
+            ("GlyphAtlas.blit", lambda img: atlas.blit(img, (1, 0), text)),
+        ]:
+            img = Image.new("1", (w, font_h * 2))
+            start = time.time()
+            for i in range(rounds):
+                fun(img)
+            stop = time.time()
+            print("%-16s usec/string: %.1f" %
+                  (name, 1000000.0 * (stop - start) / rounds))
+
+    main()
@@ -0,0 +1,294 @@
+#!/usr/bin/python3
+# Shared i2c bus manager
+# https://github.com/torvalds/linux/blob/master/include/uapi/linux/i2c-dev.h
+
+"""
+One I2CBus per physical bus owns the bus handle and serializes all
+transfers with a lock, so several helpers can share it, e.g.
+
+    bus = I2CBus(1)
+    bme = bme280.SensorBME280(bus.Device(0x76), sampler=False)
+    gyro = l3g4200d.SensorL3G4200D(bus)
+    keys = ttp229.SensorTTP229(bus=bus)
+
+I2CBus is a drop in for smbus.SMBus (for the methods used by the
+helpers, including i2c_rdwr if the bus is an smbus2.SMBus) and
+additionally supports raw reads without a register (`read_raw`) which
+is what the ttp229 needs.
+
+Periodic polls of all devices can run on a single thread via AddPoll
+(the bme280 is created with `sampler=False` so it does not start its
+own sampler thread as well), e.g.
+    bus.AddPoll("bme280", bme.Update, 1.0)
+    bus.AddPoll("keys", keys.KeyStatus, 20.0)
+    bus.Start()
+
+Demo/Test:
+./i2c_bus.py
+"""
+
+import heapq
+import logging
+import os
+import threading
+import time
+from fcntl import ioctl
+
+# smbus is only necessary when I2CBus opens the bus itself. smbus2 is
+# preferred: only it has combined transactions (i2c_rdwr)
+try:
+    import smbus2 as smbus
+    from smbus2 import i2c_msg
+except ImportError:
+    i2c_msg = None
+    try:
+        import smbus
+    except ImportError:
+        smbus = None
+
+I2C_SLAVE = 0x0703  # Use this slave address
+
+
+class I2CDevice:
+    """Device at `addr` on a shared bus with the same interface as
+    bme280.I2CDevice
+    """
+
+    def __init__(self, bus, addr):
+        self._bus = bus
+        self._addr = addr
+
+    def read(self, register, length):
+        return self._bus.read_i2c_block_data(self._addr, register, length)
+
+    def read_regions(self, regions):
+        if i2c_msg is None or not hasattr(self._bus, "i2c_rdwr"):
+            # at least no other device of this bus can interleave transfers
+            with self._bus.lock:
+                return [self.read(register, length)
+                        for register, length in regions]
+        # one combined transaction (repeated start)
+        msgs = []
+        for register, length in regions:
+            msgs.append(i2c_msg.write(self._addr, [register]))
+            msgs.append(i2c_msg.read(self._addr, length))
+        self._bus.i2c_rdwr(*msgs)
+        return [list(m) for m in msgs[1::2]]
+
+    def write(self, register, values):
+        """Plain block write, i.e. most devices store `values` in
+        consecutive registers starting at `register`
+        """
+        self._bus.write_i2c_block_data(self._addr, register, list(values))
+
+    def stats(self):
+        return self._bus.DeviceStats(self._addr)
+
+
+class _Poll:
+
+    def __init__(self, name, callback, rate_hz):
+        self.name = name
+        self.callback = callback
+        self.period = 1.0 / rate_hz
+        self.calls = 0
+        self.time = 0.0
+        self.overruns = 0
+        self.errors = 0
+
+
+class I2CBus:
+    """
+    `bus_no`: i2c bus number, i.e. /dev/i2c-<bus_no>
+    `smbus_bus`: optional already opened smbus.SMBus (mostly for testing)
+    """
+
+    def __init__(self, bus_no=1, smbus_bus=None):
+        self._bus_no = bus_no
+        if smbus_bus is None:
+            smbus_bus = smbus.SMBus(bus_no)
+        self._bus = smbus_bus
+        if hasattr(smbus_bus, "i2c_rdwr"):
+            # only offered if the bus supports it as clients check for it
+            self.i2c_rdwr = self._I2cRdwr
+        # held for every transfer, can also be held by clients to make
+        # a sequence of transfers atomic
+        self.lock = threading.RLock()
+        # raw fd for transfers without a register, opened on demand
+        self._fd = None
+        self._fd_addr = None
+        self._created = time.time()
+        self._busy = 0.0
+        self._transactions = 0
+        self._ioctls = 0
+        self._per_device = {}
+        self._polls = []
+        self._poller = None
+        self._stop = threading.Event()
+
+    def _Transfer(self, addr, fun, *args):
+        with self.lock:
+            start = time.time()
+            try:
+                return fun(addr, *args)
+            finally:
+                elapsed = time.time() - start
+                self._busy += elapsed
+                self._transactions += 1
+                d = self._per_device.get(addr)
+                if d is None:
+                    d = self._per_device[addr] = [0, 0.0]
+                d[0] += 1
+                d[1] += elapsed
+
+    # smbus.SMBus compatible interface
+    def read_byte_data(self, addr, register):
+        return self._Transfer(addr, self._bus.read_byte_data, register)
+
+    def write_byte_data(self, addr, register, value):
+        return self._Transfer(addr, self._bus.write_byte_data, register, value)
+
+    def read_i2c_block_data(self, addr, register, length):
+        return self._Transfer(addr, self._bus.read_i2c_block_data, register, length)
+
+    def write_i2c_block_data(self, addr, register, data):
+        return self._Transfer(addr, self._bus.write_i2c_block_data, register, data)
+
+    def _I2cRdwr(self, *msgs):
+        # accounted to the device of the first message
+        return self._Transfer(msgs[0].addr,
+                              lambda addr: self._bus.i2c_rdwr(*msgs))
+
+    def _ReadRaw(self, addr, length):
+        if self._fd is None:
+            self._fd = os.open("/dev/i2c-%d" % self._bus_no, os.O_RDWR)
+        # the slave address is per fd, only set it when it changes
+        if self._fd_addr != addr:
+            ioctl(self._fd, I2C_SLAVE, addr)
+            self._fd_addr = addr
+            self._ioctls += 1
+        return os.read(self._fd, length)
+
+    def read_raw(self, addr, length):
+        """Read `length` bytes from a device without selecting a register"""
+        return self._Transfer(addr, self._ReadRaw, length)
+
+    def Device(self, addr):
+        return I2CDevice(self, addr)
+
+    def DeviceStats(self, addr):
+        with self.lock:
+            transactions, bus_time = self._per_device.get(addr, (0, 0.0))
+        return {"transactions": transactions, "bus_time": bus_time}
+
+    def AddPoll(self, name, callback, rate_hz):
+        """Call `callback` `rate_hz` times per second from the poll thread"""
+        with self.lock:
+            self._polls.append(_Poll(name, callback, rate_hz))
+
+    def _Poller(self):
+        now = time.time()
+        with self.lock:
+            queue = [(now, n, p) for n, p in enumerate(self._polls)]
+        heapq.heapify(queue)
+        while queue:
+            due, n, poll = queue[0]
+            if self._stop.wait(max(0.0, due - time.time())):
+                break
+            start = time.time()
+            try:
+                poll.callback()
+            except Exception:
+                poll.errors += 1
+                logging.exception("i2c poll [%s] failed", poll.name)
+            stop = time.time()
+            poll.calls += 1
+            poll.time += stop - start
+            due += poll.period
+            if due < stop:
+                # we fell behind - do not try to catch up
+                poll.overruns += 1
+                due = stop + poll.period
+            heapq.heapreplace(queue, (due, n, poll))
+
+    def Start(self):
+        """Start the poll thread (polls must be added before)"""
+        if self._poller is not None:
+            return
+        self._stop.clear()
+        self._poller = threading.Thread(target=self._Poller, daemon=True)
+        self._poller.start()
+
+    def Stop(self):
+        if self._poller is not None:
+            self._stop.set()
+            self._poller.join()
+            self._poller = None
+
+    def close(self):
+        self.Stop()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._bus.close()
+
+    def stats(self):
+        with self.lock:
+            elapsed = time.time() - self._created
+            return {
+                "transactions": self._transactions,
+                "address_ioctls": self._ioctls,
+                "busy_time": self._busy,
+                "utilization": self._busy / elapsed if elapsed > 0 else 0.0,
+                "polls": {p.name: {"calls": p.calls, "time": p.time,
+                                   "overruns": p.overruns, "errors": p.errors}
+                          for p in self._polls},
+            }
+
+
+if __name__ == "__main__":
+    def test():
+        class FakeSMBus:
+            def __init__(self):
+                self.log = []
+
+            def read_byte_data(self, addr, register):
+                self.log.append(("rb", addr, register))
+                time.sleep(0.001)
+                return 0
+
+            def read_i2c_block_data(self, addr, register, length):
+                self.log.append(("rbl", addr, register, length))
+                return [0] * length
+
+            def write_i2c_block_data(self, addr, register, data):
+                self.log.append(("wbl", addr, register, list(data)))
+
+            def close(self):
+                pass
+
+        fake = FakeSMBus()
+        bus = I2CBus(1, smbus_bus=fake)
+        dev = bus.Device(0x76)
+        dev.write(0x20, [1, 2])
+        assert fake.log[-1] == ("wbl", 0x76, 0x20, [1, 2])
+        assert dev.read_regions([(0x88, 26), (0xe1, 7)])[1] == [0] * 7
+        if i2c_msg is not None:
+            # with i2c_rdwr the regions are read in one transaction
+            fake.i2c_rdwr = lambda *msgs: fake.log.append(("rdwr", len(msgs)))
+            rdwr_bus = I2CBus(1, smbus_bus=fake)
+            rdwr_bus.Device(0x76).read_regions([(0x88, 26), (0xe1, 7)])
+            assert fake.log[-1] == ("rdwr", 4)
+            assert rdwr_bus.stats()["transactions"] == 1
+        bus.AddPoll("fast", lambda: bus.read_byte_data(0x69, 0x28), 200.0)
+        bus.AddPoll("slow", lambda: bus.read_byte_data(0x57, 0x00), 10.0)
+        bus.Start()
+        time.sleep(0.5)
+        bus.Stop()
+        stats = bus.stats()
+        print(stats)
+        assert 80 <= stats["polls"]["fast"]["calls"] <= 110
+        assert 4 <= stats["polls"]["slow"]["calls"] <= 6
+        assert dev.stats()["transactions"] == 3
+
+    test()
@@ -7,52 +7,389 @@ Input device helper for  /dev/input/event* devices.
 Useful for many USB input devices, including:
 keyboards, mice, touchscreen, joysticks
 
+InputReader reads from any number of devices on a single thread
+using asyncio and picks up devices that are plugged in later, e.g.
+
+    def handler(device, event):
+        print(device.name, device.Lookup(event.type, event.code), event.value)
+
+    asyncio.run(InputReader(handler).Run())
+
+With `frames=True` events are grouped into Frames (everything between
+two SYN_REPORTs) and multi-touch slots are tracked. Feeding the frames
+into a FrameQueue coalesces motion when the consumer falls behind,
+so a UI loop handles at most one motion update per rendered frame
+while no press/release is lost:
+
+    queue = FrameQueue()
+    reader = InputReader(queue.Put, frames=True)
+    # start asyncio.run(reader.Run()) on a thread, then in the UI loop:
+    for device, frame in queue.Get(timeout):
+        ...
+
 This is in the experimentation stage
+
+Demo:
+./input.py                      # list devices
+./input.py /dev/input/event0    # dump events of one device
+./input.py all                  # dump events of all devices (with hotplug)
+./input.py frames               # dump coalesced frames of all devices
 """
 
+import asyncio
+import collections
+import errno
+import logging
+import threading
+import time
+
 import evdev
+from evdev import ecodes
+
+
+def _Name(name):
+    # aliases like ['BTN_LEFT', 'BTN_MOUSE'] - use the first one
+    if isinstance(name, (list, tuple)):
+        return name[0]
+    return name
+
+
+def _CapabilityIndex(capabilities):
+    """Returns a (type, code) -> (type_name, code_name) dict for
+    verbose capabilities, i.e. device.capabilities(verbose=True)
+    """
+    index = {}
+    for (type_name, ev_type), codes in capabilities.items():
+        for v in codes:
+            if isinstance(v[0], tuple):
+                # EV_ABS entries are ((name, code), AbsInfo)
+                v = v[0]
+            index[(ev_type, v[1])] = (type_name, _Name(v[0]))
+    return index
+
+
+class InputDevice:
+    """evdev.InputDevice with a capability index built once at open"""
+
+    def __init__(self, path):
+        self.device = evdev.InputDevice(path)
+        self.path = path
+        self.name = self.device.name
+        self.phys = self.device.phys
+        self.capabilities = self.device.capabilities(verbose=True)
+        self._index = _CapabilityIndex(self.capabilities)
+
+    def Lookup(self, ev_type, ev_code):
+        """Returns (type_name, code_name) for an event"""
+        names = self._index.get((ev_type, ev_code))
+        if names is None:
+            names = ("unknown_%s" % ev_type, "unknown_%s" % ev_code)
+            self._index[(ev_type, ev_code)] = names
+        return names
+
+    def close(self):
+        self.device.close()
+
+
+class Frame:
+    """All events of a device between two SYN_REPORTs
+
+    `keys`: list of (code, value) - presses/releases/repeats in order
+    `abs`: code -> latest value of absolute axes (except MT slots)
+    `rel`: code -> summed relative movement
+    `other`: (type, code) -> latest value of everything else
+    `touches`: tuple of (slot, tracking_id, x, y) of active contacts
+    `touch_changed`: contacts started or ended in this frame
+    `coalesced`: number of motion frames merged into this one
+    """
+
+    __slots__ = ["time", "keys", "abs", "rel", "other", "touches",
+                 "touch_changed", "coalesced"]
+
+    def __init__(self):
+        self.time = 0.0
+        self.keys = []
+        self.abs = {}
+        self.rel = {}
+        self.other = {}
+        self.touches = ()
+        self.touch_changed = False
+        self.coalesced = 0
+
+    def IsMotion(self):
+        """True if the frame can be merged with other motion frames"""
+        return not self.keys and not self.touch_changed
+
+    def Merge(self, newer):
+        """Fold a newer motion frame into this one"""
+        self.time = newer.time
+        self.abs.update(newer.abs)
+        for code, value in newer.rel.items():
+            self.rel[code] = self.rel.get(code, 0) + value
+        self.other.update(newer.other)
+        self.touches = newer.touches
+        self.coalesced += 1 + newer.coalesced
+
+    def __repr__(self):
+        return "Frame(keys=%s abs=%s rel=%s touches=%s coalesced=%d)" % (
+            self.keys, self.abs, self.rel, self.touches, self.coalesced)
 
 
-def _LookupCapability(capabilities, ev_type, ev_code):
-    for key, val in capabilities.items():
-        print (key, ev_type)
-        if key[-1] != ev_type:
-            continue
-        for v in val:
-            if v[-1] != ev_code:
-                continue
-            return key[0], v[0]
-    return "unknown_%s" % ev_type, "unknown_%s" % ev_code,
+class FrameAssembler:
+    """Groups the events of one device into Frames and tracks
+    multi-touch (protocol B) slots
+    """
+
+    def __init__(self):
+        self._frame = Frame()
+        self._slot = 0
+        # slot -> tracking_id, only active contacts
+        self._tracking = {}
+        # slot -> [x, y], kept across contacts as the kernel does not
+        # resend unchanged positions for a new contact in the same slot
+        self._positions = {}
+        self._dropping = False
+        self.frames = 0
+        self.dropped = 0
+
+    def _Abs(self, code, value):
+        frame = self._frame
+        if code == ecodes.ABS_MT_SLOT:
+            self._slot = value
+        elif code == ecodes.ABS_MT_TRACKING_ID:
+            frame.touch_changed = True
+            if value < 0:
+                self._tracking.pop(self._slot, None)
+            else:
+                self._tracking[self._slot] = value
+        elif code in (ecodes.ABS_MT_POSITION_X, ecodes.ABS_MT_POSITION_Y):
+            # -1: contact already active when the device was opened
+            self._tracking.setdefault(self._slot, -1)
+            position = self._positions.setdefault(self._slot, [0, 0])
+            position[code != ecodes.ABS_MT_POSITION_X] = value
+        else:
+            frame.abs[code] = value
+
+    def Feed(self, event):
+        """Returns a Frame when `event` completes one, otherwise None"""
+        t = event.type
+        if t == ecodes.EV_SYN:
+            if event.code == ecodes.SYN_DROPPED:
+                # the kernel buffer overflowed, drop until the next report
+                self._dropping = True
+                self.dropped += 1
+                self._frame = Frame()
+                return None
+            if event.code != ecodes.SYN_REPORT:
+                return None
+            if self._dropping:
+                self._dropping = False
+                self._frame = Frame()
+                return None
+            frame = self._frame
+            self._frame = Frame()
+            frame.time = event.timestamp()
+            positions = self._positions
+            frame.touches = tuple(
+                (s, t) + tuple(positions.get(s, (0, 0)))
+                for s, t in sorted(self._tracking.items()))
+            self.frames += 1
+            return frame
+        if self._dropping:
+            return None
+        if t == ecodes.EV_KEY:
+            self._frame.keys.append((event.code, event.value))
+        elif t == ecodes.EV_ABS:
+            self._Abs(event.code, event.value)
+        elif t == ecodes.EV_REL:
+            rel = self._frame.rel
+            rel[event.code] = rel.get(event.code, 0) + event.value
+        else:
+            self._frame.other[(t, event.code)] = event.value
+        return None
+
+
+class FrameQueue:
+    """Thread safe queue of (device, Frame) which merges consecutive
+    motion frames of the same device that the consumer has not
+    picked up yet.
+
+    `maxlen`: oldest entries beyond this are dropped (and counted)
+    `notify`: optional function called after each Put, e.g. to wake up
+        a main loop which polls with Get(0)
+    """
+
+    def __init__(self, maxlen=1024, notify=None):
+        self._frames = collections.deque()
+        self._maxlen = maxlen
+        self._notify = notify
+        self._cond = threading.Condition()
+        self.received = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def Put(self, device, frame):
+        self._Put(device, frame)
+        if self._notify is not None:
+            self._notify()
+
+    def _Put(self, device, frame):
+        with self._cond:
+            self.received += 1
+            if self._frames:
+                last_device, last = self._frames[-1]
+                if (last_device is device and last.IsMotion()
+                        and frame.IsMotion()):
+                    last.Merge(frame)
+                    self.coalesced += 1
+                    return
+            if len(self._frames) >= self._maxlen:
+                self._frames.popleft()
+                self.dropped += 1
+            self._frames.append((device, frame))
+            self._cond.notify()
+
+    def Get(self, timeout=None):
+        """Returns all pending (device, Frame)s, [] on timeout"""
+        with self._cond:
+            if not self._frames:
+                self._cond.wait(timeout)
+            out = list(self._frames)
+            self._frames.clear()
+            return out
+
+    def stats(self):
+        with self._cond:
+            return {
+                "received": self.received,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+            }
+
+
+class InputReader:
+    """Multiplexes many input devices in one thread
+
+    `callback`: called with (InputDevice, evdev.InputEvent) for every
+        event or with (InputDevice, Frame) for every frame if `frames`
+    `match`: optional predicate on InputDevice selecting devices to read
+    `rescan_interval`: secs between scans for added devices (hotplug)
+    """
+
+    def __init__(self, callback, match=None, rescan_interval=2.0,
+                 frames=False):
+        self._callback = callback
+        self._frames = frames
+        self._match = match
+        self._rescan_interval = rescan_interval
+        # path -> (InputDevice, asyncio.Task)
+        self._devices = {}
+        # paths that did not match or could not be opened
+        self._ignored = set()
+        self.events = 0
+
+    def Devices(self):
+        return [d for d, _ in self._devices.values()]
+
+    async def _Read(self, device):
+        assembler = FrameAssembler() if self._frames else None
+        try:
+            async for event in device.device.async_read_loop():
+                self.events += 1
+                if assembler is not None:
+                    event = assembler.Feed(event)
+                    if event is None:
+                        continue
+                try:
+                    self._callback(device, event)
+                except Exception:
+                    logging.exception("input callback failed")
+        except OSError as err:
+            if err.errno != errno.ENODEV:
+                logging.exception("reading [%s] failed", device.path)
+        logging.info("input device removed [%s] %s", device.path, device.name)
+        del self._devices[device.path]
+        device.close()
+
+    def _Open(self, path):
+        try:
+            device = InputDevice(path)
+        except OSError as err:
+            logging.warning("cannot open [%s]: %s", path, err)
+            self._ignored.add(path)
+            return
+        if self._match is not None and not self._match(device):
+            device.close()
+            self._ignored.add(path)
+            return
+        logging.info("input device added [%s] %s", path, device.name)
+        task = asyncio.get_running_loop().create_task(self._Read(device))
+        self._devices[path] = (device, task)
+
+    def Rescan(self):
+        """Opens devices that appeared since the last scan"""
+        paths = set(evdev.list_devices())
+        # a removed path may come back with a different device
+        self._ignored &= paths
+        for path in sorted(paths - set(self._devices) - self._ignored):
+            self._Open(path)
+
+    async def Run(self):
+        try:
+            while True:
+                self.Rescan()
+                await asyncio.sleep(self._rescan_interval)
+        finally:
+            for device, task in list(self._devices.values()):
+                task.cancel()
+                device.close()
+            self._devices.clear()
 
 
 if __name__ == "__main__":
     import sys
 
-
-    def DumpEvents(device):
-        capabilities = device.capabilities(True)
+    def DumpEvents(path):
+        device = InputDevice(path)
         print(device.name, device.phys)
-        for key, val in capabilities.items():
+        for key, val in device.capabilities.items():
             print(key)
             for v in val:
                 print("   ", v)
 
-        cache = {}
-        for event in device.read_loop():
-            ev_code = event.code
-            ev_type = event.type
-            x = cache.get((ev_type, ev_code))
-            if not x:
-                x = _LookupCapability(capabilities, ev_type, ev_code)
-                cache[(ev_type, ev_code)] = x
+        for event in device.device.read_loop():
+            print("%5s %10s" % device.Lookup(event.type, event.code),
+                  event.value)
+
+    def DumpAllEvents():
+        def handler(device, event):
+            print("%-20s %5s %10s" % ((device.name[:20],) +
+                                      device.Lookup(event.type, event.code)),
+                  event.value)
 
-            print("%5s %10s" % x, event.value)
+        logging.basicConfig(level=logging.INFO)
+        asyncio.run(InputReader(handler).Run())
 
+    def DumpFrames():
+        logging.basicConfig(level=logging.INFO)
+        queue = FrameQueue()
+        reader = InputReader(queue.Put, frames=True)
+        threading.Thread(target=asyncio.run, args=(reader.Run(),),
+                         daemon=True).start()
+        while True:
+            for device, frame in queue.Get():
+                print(device.name[:20], frame)
+            # simulate rendering
+            time.sleep(1 / 30)
+            print(queue.stats())
 
-    if len(sys.argv) == 2:
+    if len(sys.argv) == 2 and sys.argv[1] == "all":
+        DumpAllEvents()
+    elif len(sys.argv) == 2 and sys.argv[1] == "frames":
+        DumpFrames()
+    elif len(sys.argv) == 2:
         print("dumping events for ", sys.argv[1])
-        device = evdev.InputDevice(sys.argv[1])
-        DumpEvents(device)
+        DumpEvents(sys.argv[1])
     else:
         if len(evdev.list_devices()) == 0:
             print("no devices found - maybe you need to be root")
@@ -2,42 +2,317 @@
 # 3 axis gyroscope
 # cf.: https://cdn.sparkfun.com/datasheets/Sensors/Gyros/3-Axis/CD00265057.pdf
 
-import smbus
+import logging
+import struct
+import threading
+import time
 
+# optional: only needed for streaming
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-def _read_s16(bus, addr, reg0, reg1):
-    v = bus.read_byte_data(addr, reg0) + 256 * bus.read_byte_data(addr, reg1)
-    if v > 32767:
-        v -= 65536
-    return v
+# smbus2 is preferred: only it allows reading the whole fifo in one
+# transaction (python-smbus has no i2c_rdwr)
+try:
+    import smbus2 as smbus
+    from smbus2 import i2c_msg
+except ImportError:
+    import smbus
+    i2c_msg = None
+
+_REG_WHO_AM_I = 0x0f
+_REG_CTRL1 = 0x20
+_REG_CTRL4 = 0x23
+_REG_CTRL5 = 0x24
+_REG_OUT_TEMP = 0x26
+_REG_OUT_X_L = 0x28
+_REG_FIFO_CTRL = 0x2e
+_REG_FIFO_SRC = 0x2f
+
+# setting the msb of the register address enables auto increment
+_AUTO_INCREMENT = 0x80
+
+_CTRL4_BDU = 0x80  # block data update - no torn samples
+_CTRL5_FIFO_EN = 0x40
+_FIFO_MODE_BYPASS = 0x00
+_FIFO_MODE_STREAM = 0x40
+_FIFO_SRC_OVRN = 0x40
+_FIFO_SRC_EMPTY = 0x20
+_FIFO_SRC_FSS = 0x1f
+_FIFO_SIZE = 32
+
+# max bytes of a smbus block read
+_MAX_BLOCK = 32
+_SAMPLE_BYTES = 6
+
+# output data rate in Hz -> DR bits
+ODR_HZ = {100: 0, 200: 1, 400: 2, 800: 3}
+
+# full scale in degrees per sec -> FS bits
+FULL_SCALE_DPS = {250: 0, 500: 1, 2000: 2}
+
+# full scale in degrees per sec -> degrees per sec per digit
+SENSITIVITY_DPS = {250: 0.00875, 500: 0.0175, 2000: 0.070}
 
 
 class SensorL3G4200D:
+    """
+    `bus`: smbus.SMBus or a shared i2c_bus.I2CBus (default: bus 1)
+    `odr`: output data rate in Hz, see ODR_HZ
+    `bandwidth`: 0-3 low pass cut off selection, meaning depends on `odr`
+    `full_scale`: in degrees per sec, see FULL_SCALE_DPS
+    """
 
-    def __init__(self, bus=smbus.SMBus(1), addr=0x69):
+    def __init__(self, bus=None, addr=0x69, odr=100, bandwidth=0, full_scale=2000):
+        if bus is None:
+            bus = smbus.SMBus(1)
         self._bus = bus
         self._addr = addr
         # setup
-        v = self._bus.read_byte_data(self._addr, 0x0f)
+        v = self._bus.read_byte_data(self._addr, _REG_WHO_AM_I)
         assert v == 0xd3, "wrong device"
 
         # enable all axes, normal mod
-        self._bus.write_byte_data(self._addr, 0x20, 0x0F)
-        # Litte Endian, 2000dpsm, no self test, 4 wire
-        self._bus.write_byte_data(self._addr, 0x23, 0x30)
+        self.SetDataRate(odr, bandwidth)
+        # Litte Endian, block data update, no self test, 4 wire
+        self.full_scale = full_scale
+        self._bus.write_byte_data(self._addr, _REG_CTRL4,
+                                  _CTRL4_BDU | FULL_SCALE_DPS[full_scale] << 4)
+        # streaming
+        self._lock = threading.Lock()
+        self._streamer = None
+        self._stop = threading.Event()
+        self._ring_t = None
+        self._ring = None
+        self._written = 0
+        self._read_pos = 0
+        self._samples = 0
+        self._fifo_overruns = 0
+        self._ring_drops = 0
+        self._transactions = 0
+
+    def SetDataRate(self, odr, bandwidth=0):
+        self.odr = odr
+        self._bus.write_byte_data(self._addr, _REG_CTRL1,
+                                  ODR_HZ[odr] << 6 | bandwidth << 4 | 0x0F)
 
     def Rotation(self):
-        x = _read_s16(self._bus, self._addr, 0x28, 0x29)
-        y = _read_s16(self._bus, self._addr, 0x2a, 0x2b)
-        z = _read_s16(self._bus, self._addr, 0x2c, 0x2d)
-        return x, y, z
+        """Returns one raw x, y, z sample read in a single transaction.
+        Do not use while streaming.
+        """
+        data = self._bus.read_i2c_block_data(
+            self._addr, _REG_OUT_X_L | _AUTO_INCREMENT, _SAMPLE_BYTES)
+        return struct.unpack("<hhh", bytes(data))
 
     def Temperature(self):
-        return self._bus.read_byte_data(self._addr, 0x26)
+        return self._bus.read_byte_data(self._addr, _REG_OUT_TEMP)
+
+    def _ReadSamples(self, n):
+        """Reads `n` samples from the output registers (or fifo)
+        Each read starting at OUT_X_L pops samples from the fifo.
+        """
+        reg = _REG_OUT_X_L | _AUTO_INCREMENT
+        if i2c_msg is not None and hasattr(self._bus, "i2c_rdwr"):
+            w = i2c_msg.write(self._addr, [reg])
+            r = i2c_msg.read(self._addr, n * _SAMPLE_BYTES)
+            self._bus.i2c_rdwr(w, r)
+            self._transactions += 1
+            return bytes(r)
+        out = bytearray()
+        per_read = _MAX_BLOCK // _SAMPLE_BYTES
+        while n > 0:
+            k = min(n, per_read)
+            out += bytes(self._bus.read_i2c_block_data(
+                self._addr, reg, k * _SAMPLE_BYTES))
+            self._transactions += 1
+            n -= k
+        return bytes(out)
+
+    def _Store(self, ts, samples):
+        capacity = len(self._ring)
+        n = len(samples)
+        with self._lock:
+            start = self._written % capacity
+            first = min(n, capacity - start)
+            self._ring_t[start:start + first] = ts[:first]
+            self._ring[start:start + first] = samples[:first]
+            self._ring_t[:n - first] = ts[first:]
+            self._ring[:n - first] = samples[first:]
+            self._written += n
+            self._samples += n
+
+    def _Streamer(self):
+        # drain when the fifo is about half full
+        period = _FIFO_SIZE / 2 / self.odr
+        while not self._stop.wait(period):
+            try:
+                src = self._bus.read_byte_data(self._addr, _REG_FIFO_SRC)
+                self._transactions += 1
+                if src & _FIFO_SRC_OVRN:
+                    self._fifo_overruns += 1
+                    n = _FIFO_SIZE
+                elif src & _FIFO_SRC_EMPTY:
+                    continue
+                else:
+                    n = src & _FIFO_SRC_FSS
+                data = self._ReadSamples(n)
+                now = time.time()
+            except Exception:
+                logging.exception("l3g4200d fifo read failed")
+                continue
+            samples = numpy.frombuffer(data, dtype="<i2").reshape(n, 3)
+            # the last sample is the most recent one
+            ts = now - numpy.arange(n - 1, -1, -1) / self.odr
+            self._Store(ts, samples)
+
+    def StartStream(self, capacity=8192):
+        """Drain the chip's fifo into a ring buffer holding the most
+        recent `capacity` samples on a background thread.
+        Use ReadStream to get the samples.
+        """
+        if self._streamer is not None:
+            return
+        self._ring_t = numpy.zeros(capacity, dtype=numpy.float64)
+        self._ring = numpy.zeros((capacity, 3), dtype=numpy.int16)
+        self._written = 0
+        self._read_pos = 0
+        self._bus.write_byte_data(self._addr, _REG_CTRL5, _CTRL5_FIFO_EN)
+        self._bus.write_byte_data(self._addr, _REG_FIFO_CTRL, _FIFO_MODE_STREAM)
+        self._stop.clear()
+        self._streamer = threading.Thread(target=self._Streamer, daemon=True)
+        self._streamer.start()
+
+    def StopStream(self):
+        if self._streamer is None:
+            return
+        self._stop.set()
+        self._streamer.join()
+        self._streamer = None
+        self._bus.write_byte_data(self._addr, _REG_FIFO_CTRL, _FIFO_MODE_BYPASS)
+        self._bus.write_byte_data(self._addr, _REG_CTRL5, 0)
+
+    def ReadStream(self):
+        """Returns (timestamps, samples) of all samples received since the
+        last call. samples is an Nx3 int16 array of raw x, y, z.
+        Samples that were overwritten before being read count as drops.
+        """
+        with self._lock:
+            capacity = len(self._ring)
+            available = self._written - self._read_pos
+            if available > capacity:
+                self._ring_drops += available - capacity
+                self._read_pos = self._written - capacity
+                available = capacity
+            idx = (self._read_pos + numpy.arange(available)) % capacity
+            self._read_pos = self._written
+            return self._ring_t[idx], self._ring[idx]
+
+    def StreamStats(self):
+        return {
+            "samples": self._samples,
+            "fifo_overruns": self._fifo_overruns,
+            "ring_drops": self._ring_drops,
+            "transactions": self._transactions,
+        }
+
+
+class GyroProcessor:
+    """Turns blocks of raw samples (e.g. from ReadStream) into rates
+    and angles
+
+    `odr`, `full_scale`: must match the sensor settings
+    `taps`: length of the moving average low pass in samples (1 = off)
+    `still_threshold`: blocks whose per axis std dev (in degrees per sec)
+    is below this and whose mean is close to the current bias are
+    considered still and used to track the zero rate bias. The first
+    still block sets the initial bias unless Calibrate was called.
+    `bias_alpha`: weight of a still block when updating the bias
+    `min_still`: minimum number of samples for a block to count as still
+    """
+
+    def __init__(self, odr, full_scale=2000, taps=8, still_threshold=0.5,
+                 bias_alpha=0.1, min_still=32):
+        self._dt = 1.0 / odr
+        self._scale = SENSITIVITY_DPS[full_scale]
+        self._taps = taps
+        self._still_threshold = still_threshold
+        self._bias_alpha = bias_alpha
+        self._min_still = min_still
+        self.bias = None
+        self.angle = numpy.zeros(3)
+        self._tail = None
+        self._blocks = 0
+        self._samples = 0
+        self._still_blocks = 0
+        self._time = 0.0
+
+    def Reset(self):
+        """Zero the integrated angle (the bias estimate is kept)"""
+        self.angle = numpy.zeros(3)
+
+    def Calibrate(self, samples):
+        """Set the bias from raw samples taken while the sensor was still"""
+        self.bias = samples.mean(axis=0) * self._scale
+
+    def _UpdateBias(self, rate):
+        if len(rate) < self._min_still:
+            return
+        if rate.std(axis=0).max() >= self._still_threshold:
+            return
+        mean = rate.mean(axis=0)
+        if self.bias is None:
+            self.bias = mean
+        elif numpy.abs(mean - self.bias).max() < self._still_threshold:
+            # a steady turn has a small std dev, too
+            self.bias += self._bias_alpha * (mean - self.bias)
+        else:
+            return
+        self._still_blocks += 1
+
+    def _LowPass(self, rate):
+        if self._taps <= 1:
+            return rate
+        if self._tail is None:
+            self._tail = numpy.repeat(rate[:1], self._taps - 1, axis=0)
+        x = numpy.concatenate((self._tail, rate))
+        self._tail = x[len(x) - self._taps + 1:]
+        c = numpy.cumsum(x, axis=0)
+        c = numpy.concatenate((numpy.zeros((1, 3)), c))
+        return (c[self._taps:] - c[:-self._taps]) / self._taps
+
+    def Process(self, samples):
+        """`samples`: Nx3 raw x, y, z
+        Returns (rate, angle), both Nx3 in degrees per sec and degrees
+        """
+        start = time.time()
+        rate = samples * self._scale
+        if len(rate) == 0:
+            return rate, numpy.zeros((0, 3))
+        self._UpdateBias(rate)
+        if self.bias is not None:
+            rate -= self.bias
+        rate = self._LowPass(rate)
+        angle = self.angle + numpy.cumsum(rate, axis=0) * self._dt
+        self.angle = angle[-1].copy()
+        self._blocks += 1
+        self._samples += len(rate)
+        self._time += time.time() - start
+        return rate, angle
+
+    def stats(self):
+        return {
+            "blocks": self._blocks,
+            "samples": self._samples,
+            "still_blocks": self._still_blocks,
+            "process_time": self._time,
+            "bias": None if self.bias is None else self.bias.tolist(),
+        }
 
 
 if __name__ == "__main__":
-    import time
+    import sys
 
     def main():
         sensor = SensorL3G4200D()
@@ -47,4 +322,50 @@ if __name__ == "__main__":
             print("x %6d  y %6d  z %6d  t %3d" % (x, y, z, t))
             time.sleep(0.5)
 
-    main()
+    def stream():
+        sensor = SensorL3G4200D(odr=800)
+        proc = GyroProcessor(sensor.odr, sensor.full_scale)
+        sensor.StartStream()
+        for i in range(10):
+            time.sleep(1.0)
+            ts, samples = sensor.ReadStream()
+            rate = len(ts) / (ts[-1] - ts[0]) if len(ts) > 1 else 0
+            _, angle = proc.Process(samples)
+            print("samples %5d  rate %6.1f Hz  angle %s" %
+                  (len(ts), rate, angle[-1] if len(angle) else None),
+                  sensor.StreamStats())
+        sensor.StopStream()
+        print(proc.stats())
+
+    def benchmark():
+        odr = 800
+        proc = GyroProcessor(odr, 2000)
+        rng = numpy.random.default_rng(1)
+        bias = numpy.array([12, -7, 3])
+        # 2 secs still followed by 90 degrees around z in 1 sec
+        still = rng.normal(bias, 3, (2 * odr, 3)).astype(numpy.int16)
+        turn = rng.normal(bias, 3, (odr, 3))
+        turn[:, 2] += 90 / SENSITIVITY_DPS[2000]
+        samples = numpy.concatenate((still, turn.astype(numpy.int16)))
+        for block in numpy.split(samples, len(samples) // 32):
+            _, angle = proc.Process(block)
+        print("angle after turn", angle[-1], proc.stats())
+        assert abs(angle[-1][2] - 90) < 1.0
+        assert abs(angle[-1][0]) < 0.5 and abs(angle[-1][1]) < 0.5
+
+        rounds = 1000
+        block = still[:32]
+        start = time.time()
+        for i in range(rounds):
+            proc.Process(block)
+        elapsed = time.time() - start
+        print("usec/block(32): %.1f  core fraction at %d Hz: %.3f" %
+              (1000000.0 * elapsed / rounds, odr,
+               elapsed / (rounds * 32 / odr)))
+
+    if len(sys.argv) > 1 and sys.argv[1] == "stream":
+        stream()
+    elif len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        benchmark()
+    else:
+        main()
@@ -9,37 +9,480 @@ Demo/Test:
 """
 
 
-from PIL import Image, ImageDraw, ImageFont
+import bisect
+import collections
+import time
+
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+
+
+def _DrawText(image, xy, text, font):
+    # `font` may also be a glyph_atlas.GlyphAtlas (or anything else
+    # with a `blit` method) which is much faster than ImageDraw.text
+    blit = getattr(font, "blit", None)
+    if blit is not None:
+        blit(image, xy, text)
+    else:
+        ImageDraw.Draw(image).text(xy, text, fill="white", font=font)
 
 
 def _RenderFullMenu(font, line_w, line_h, entries):
     out = Image.new("1", (line_w, line_h * (1 + len(entries))))
-    draw = ImageDraw.Draw(out)
     for n, e in enumerate(entries):
-        draw.text((1, n * line_h), e,  fill="white", font=font)
+        _DrawText(out, (1, n * line_h), e, font)
     # print("FULL", out.size)
     return out
 
 
-class Menu(object):
+def _RenderRow(font, line_w, line_h, entry):
+    # glyphs may extend below line_h - keep them so that composing
+    # rows gives the same result as _RenderFullMenu
+    bottom = font.getbbox(entry)[3] if entry else 0
+    out = Image.new("1", (line_w, max(line_h, bottom)))
+    _DrawText(out, (1, 0), entry, font)
+    return out
+
+
+class _PrerenderedMenu(object):
+    """Prerendered full menu image which can be patched in place
+    when entries change.
+    """
+
+    def __init__(self, font, line_w, line_h, entries, cache_rows):
+        self._font = font
+        self._line_w = line_w
+        self._line_h = line_h
+        self._entries = entries
+        self._cache_rows = cache_rows
+        self._cache = None
+        # entry -> bottom of its bounding box
+        self._bottoms = {}
+        self._image = _RenderFullMenu(font, line_w, line_h, entries)
+
+    def View(self, entries):
+        return _FilteredMenu(self, entries)
+
+    def Fits(self, n):
+        """True if row `n` can be cropped from the prerendered image,
+        i.e. neither it nor the row above overflow their line
+        """
+        for i in (n - 1, n):
+            if i < 0:
+                continue
+            entry = self._entries[i]
+            bottom = self._bottoms.get(entry)
+            if bottom is None:
+                bottom = self._font.getbbox(entry)[3] if entry else 0
+                self._bottoms[entry] = bottom
+            if bottom > self._line_h:
+                return False
+        return True
+
+    def Tile(self, entry):
+        # the tile cache is only created when first needed and then
+        # kept for reuse
+        if self._cache is None:
+            self._cache = _TileCache(
+                self._font, self._line_w, self._line_h, self._cache_rows)
+        return self._cache.Tile(entry)
+
+    def _Redraw(self, n):
+        # Rows may overflow into the next row, so clear the band of
+        # rows `n` and `n + 1` and redraw everything that touches it.
+        h = self._line_h
+        ImageDraw.Draw(self._image).rectangle(
+            (0, n * h, self._line_w, (n + 2) * h - 1), fill="black")
+        for i in range(max(0, n - 1), min(len(self._entries), n + 2)):
+            _DrawText(self._image, (1, i * h), self._entries[i], self._font)
+
+    def _Resize(self, n, delta):
+        # shift the rows starting at `n` by `delta` rows
+        h = self._line_h
+        old = self._image
+        w, old_h = old.size
+        self._image = Image.new("1", (w, old_h + delta * h))
+        self._image.paste(old.crop((0, 0, w, n * h)), (0, 0))
+        src = n * h if delta > 0 else (n - delta) * h
+        self._image.paste(old.crop((0, src, w, old_h)), (0, src + delta * h))
+
+    def EntryChanged(self, n):
+        self._Redraw(n)
+
+    def EntryInserted(self, n):
+        self._Resize(n, 1)
+        self._Redraw(n)
+
+    def EntryRemoved(self, n):
+        self._Resize(n, -1)
+        self._Redraw(n)
+
+    def crop(self, rect):
+        return self._image.crop(rect)
+
+    def stats(self):
+        # only filtered views use the tile cache (for overflowing rows)
+        if self._cache is None:
+            return {}
+        return self._cache.stats()
+
+
+class _FilteredMenu(object):
+    """Filtered view of a _PrerenderedMenu
+
+    Rows are cropped from the prerendered image. Only rows which
+    overflow into a neighbour (and so cannot be cut out cleanly) are
+    rendered again.
+    """
+
+    def __init__(self, full, entries):
+        self._full = full
+        self._entries = entries
+
+    def crop(self, rect):
+        x0, y0, x1, y1 = rect
+        out = Image.new("1", (x1 - x0, y1 - y0))
+        full = self._full
+        h = full._line_h
+        first = max(0, y0 // h - 1)
+        last = min(len(self._entries), (y1 - 1) // h + 2)
+        for n in range(first, last):
+            i = self._entries.index(n)
+            if full.Fits(i):
+                row = full._image.crop((x0, i * h, x1, (i + 1) * h))
+                out.paste(row, (0, n * h - y0), row)
+            else:
+                tile = full.Tile(self._entries[n])
+                out.paste(tile, (-x0, n * h - y0), tile)
+        return out
+
+
+class _TileCache(object):
+    """LRU cache of rendered rows keyed by entry text"""
+
+    def __init__(self, font, line_w, line_h, cache_rows):
+        assert cache_rows > 0
+        self._font = font
+        self._line_w = line_w
+        self._line_h = line_h
+        self._cache_rows = cache_rows
+        self._tiles = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._render_time = 0.0
+        self.compose_time = 0.0
+
+    def Tile(self, entry):
+        tile = self._tiles.get(entry)
+        if tile is not None:
+            self._hits += 1
+            self._tiles.move_to_end(entry)
+            return tile
+        self._misses += 1
+        start = time.time()
+        tile = _RenderRow(self._font, self._line_w, self._line_h, entry)
+        self._render_time += time.time() - start
+        self._tiles[entry] = tile
+        if len(self._tiles) > self._cache_rows:
+            self._tiles.popitem(last=False)
+            self._evictions += 1
+        return tile
+
+    def stats(self):
+        return {
+            "cached_rows": len(self._tiles),
+            "hits": self._hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+            "render_time": self._render_time,
+            "compose_time": self.compose_time,
+        }
+
+
+class _VirtualMenu(object):
+    """Stand-in for the prerendered full menu image.
+
+    Rows are rendered on demand and kept in a _TileCache.
+    Only `crop` is supported which composes the requested window plus
+    one row of overscroll.
+    """
+
+    def __init__(self, line_h, entries, cache):
+        self._line_h = line_h
+        self._entries = entries
+        self._cache = cache
+
+    def View(self, entries):
+        return _VirtualMenu(self._line_h, entries, self._cache)
+
+    # Tiles are keyed by entry text so there is nothing to invalidate
+    def EntryChanged(self, n):
+        pass
+
+    def EntryInserted(self, n):
+        pass
+
+    def EntryRemoved(self, n):
+        pass
+
+    def crop(self, rect):
+        start = time.time()
+        x0, y0, x1, y1 = rect
+        out = Image.new("1", (x1 - x0, y1 - y0))
+        h = self._line_h
+        # the row above may overflow into the window, the row below
+        # is rendered ahead of time for smooth scrolling
+        first = max(0, y0 // h - 1)
+        last = min(len(self._entries), (y1 - 1) // h + 2)
+        for n in range(first, last):
+            tile = self._cache.Tile(self._entries[n])
+            out.paste(tile, (-x0, n * h - y0), tile)
+        self._cache.compose_time += time.time() - start
+        return out
+
+    def stats(self):
+        return self._cache.stats()
+
+
+def _DamagedRects(old, new, band_h):
+    """Returns the rectangles (x0, y0, x1, y1) which differ between
+    two (origin, image) pairs. Changes are collected per band of
+    `band_h` pixel rows and adjacent changed bands are merged.
+    """
+    (ox, oy), old_img = old
+    (nx, ny), new_img = new
+    x0 = min(ox, nx)
+    y0 = min(oy, ny)
+    x1 = max(ox + old_img.size[0], nx + new_img.size[0])
+    y1 = max(oy + old_img.size[1], ny + new_img.size[1])
+    a = Image.new("1", (x1 - x0, y1 - y0))
+    a.paste(old_img, (ox - x0, oy - y0))
+    b = Image.new("1", (x1 - x0, y1 - y0))
+    b.paste(new_img, (nx - x0, ny - y0))
+    diff = ImageChops.logical_xor(a, b)
+    out = []
+    last_end = None
+    for y in range(0, y1 - y0, band_h):
+        box = diff.crop((0, y, x1 - x0, y + band_h)).getbbox()
+        if box is None:
+            continue
+        rect = (x0 + box[0], y0 + y + box[1], x0 + box[2], y0 + y + box[3])
+        if last_end == y and out:
+            prev = out[-1]
+            rect = (min(prev[0], rect[0]), prev[1],
+                    max(prev[2], rect[2]), rect[3])
+            out[-1] = rect
+        else:
+            out.append(rect)
+        last_end = y + band_h
+    return out
+
+
+# sorts after every other character - used for prefix range queries
+_MAX_CHAR = chr(0x10FFFF)
+
+# default size of the row tile cache in virtual mode
+_CACHE_ROWS = 64
+
+
+def _MakeFullMenu(font, line_w, line_h, entries, virtual, cache_rows):
+    if virtual:
+        cache = _TileCache(font, line_w, line_h, cache_rows)
+        return _VirtualMenu(line_h, entries, cache)
+    # Prerender the menu as if we have unlimited rows
+    return _PrerenderedMenu(font, line_w, line_h, entries, cache_rows)
+
+
+class _EntriesView(object):
+    """Read-only view of the `entries` selected by `indices`"""
+
+    def __init__(self, entries, indices):
+        self._entries = entries
+        self._indices = indices
+
+    def __len__(self):
+        return len(self._indices)
+
+    def __getitem__(self, n):
+        return self._entries[self._indices[n]]
+
+    def index(self, n):
+        """Index of the `n`th entry in the unfiltered entries"""
+        return self._indices[n]
+
+
+class EntryFilter(object):
+    """Incremental type-ahead filter for menu entries
+
+    The index is built once, after that each `push` of a character only
+    narrows the previous result. `pop` (backspace) is free.
+    Matching is case insensitive.
+    `mode`: "prefix" or "substring"
+
+    Pass `matches()` to Menu.set_filter to show the filtered entries.
+    """
+
+    def __init__(self, entries, mode="substring"):
+        assert mode in ("prefix", "substring")
+        self._mode = mode
+        self._query = ""
+        texts = [e.lower() for e in entries]
+        self._num_entries = len(texts)
+        if mode == "prefix":
+            order = sorted(range(len(texts)), key=texts.__getitem__)
+            self._keys = [texts[i] for i in order]
+            self._order = order
+            # stack of (lo, hi) ranges into self._keys
+            self._stack = [(0, len(order))]
+        else:
+            self._texts = texts
+            chars = {}
+            bigrams = {}
+            for i, t in enumerate(texts):
+                for c in set(t):
+                    chars.setdefault(c, []).append(i)
+                for b in set(t[j:j + 2] for j in range(len(t) - 1)):
+                    bigrams.setdefault(b, []).append(i)
+            self._chars = chars
+            self._bigrams = bigrams
+            # stack of matching entry indices
+            self._stack = [range(len(texts))]
+        self._matches = None
+
+    def query(self):
+        return self._query
+
+    def push(self, c):
+        """Extends the query by `c` and returns the number of matches"""
+        q = self._query + c.lower()
+        if self._mode == "prefix":
+            lo, hi = self._stack[-1]
+            lo = bisect.bisect_left(self._keys, q, lo, hi)
+            hi = bisect.bisect_left(self._keys, q + _MAX_CHAR, lo, hi)
+            self._stack.append((lo, hi))
+        elif len(q) == 1:
+            self._stack.append(self._chars.get(q, []))
+        elif len(q) == 2:
+            self._stack.append(self._bigrams.get(q, []))
+        else:
+            texts = self._texts
+            self._stack.append([i for i in self._stack[-1] if q in texts[i]])
+        self._query = q
+        self._matches = None
+        return self._count()
+
+    def pop(self):
+        """Removes the last character of the query"""
+        if self._query:
+            self._stack.pop()
+            self._query = self._query[:-1]
+            self._matches = None
+        return self._count()
+
+    def clear(self):
+        del self._stack[1:]
+        self._query = ""
+        self._matches = None
+
+    def _count(self):
+        if self._mode == "prefix":
+            lo, hi = self._stack[-1]
+            return hi - lo
+        return len(self._stack[-1])
+
+    def matches(self):
+        """Indices of the matching entries in menu order"""
+        if self._matches is None:
+            if self._mode == "prefix":
+                lo, hi = self._stack[-1]
+                self._matches = sorted(self._order[lo:hi])
+            else:
+                self._matches = self._stack[-1]
+        return self._matches
+
+
+class _MenuBase(object):
+    """Functionality shared by Menu and MenuCentered
+
+    Use the *_entry methods rather than modifying `entries` directly
+    so that only the affected rows are re-rendered.
+    """
+
+    def set_filter(self, indices):
+        """Only show the entries at `indices`, e.g. EntryFilter.matches().
+        `None` shows all entries again.
+        Rows already rendered are reused for the filtered view.
+        """
+        if indices is None:
+            self._view = self._full_menu
+        else:
+            self._view = self._full_menu.View(
+                _EntriesView(self.entries, indices))
+
+    def set_entry(self, n, entry):
+        if self.entries[n] == entry:
+            return
+        self.entries[n] = entry
+        self._full_menu.EntryChanged(n)
+
+    # Note: inserting or removing entries drops the current filter
+    # as its indices are no longer valid
+    def insert_entry(self, n, entry):
+        n = min(n, len(self.entries))
+        self.entries.insert(n, entry)
+        self._full_menu.EntryInserted(n)
+        self._view = self._full_menu
+
+    def remove_entry(self, n):
+        del self.entries[n]
+        self._full_menu.EntryRemoved(n)
+        self._view = self._full_menu
+
+    def stats(self):
+        """Cache and render time stats of the row tiles - mostly empty
+        unless in virtual mode
+        """
+        return self._full_menu.stats()
+
+    def _Show(self, canvas, origin, img, damage):
+        canvas.bitmap(origin, img, fill="white")
+        last = self._last_draw
+        self._last_draw = (origin, img)
+        if not damage:
+            return None
+        if last is None:
+            x, y = origin
+            w, h = img.size
+            return [(x, y, x + w, y + h)]
+        return _DamagedRects(last, self._last_draw, self._line_h)
+
+
+class Menu(_MenuBase):
     """Simple menu helper
-    `font`: font to draw the menu enriess with
+    `font`: font to draw the menu enriess with - this can also be
+       a glyph_atlas.GlyphAtlas for faster rendering
     'num_rows`: how many rows are visible
     `line_w', `line_h`: dimension of each row
     `entries`: text of menu entries to be show - add space to end to avoid drawing bug
     `y_offset`: font dependent fudge offset. Try small integers starting with zero.
+    `virtual`: render rows on demand instead of prerendering all entries.
+       Recommended for very large menus.
+    `cache_rows`: number of rendered rows kept around in virtual mode
 
     """
 
-    def __init__(self, font, num_rows, line_w, line_h, entries, active_entry_index, y_offset=0):
+    def __init__(self, font, num_rows, line_w, line_h, entries, active_entry_index, y_offset=0,
+                 virtual=False, cache_rows=_CACHE_ROWS):
         self._font = font
         self._num_rows = num_rows
         self._line_w = line_w
         self._line_h = line_h
         self.entries = entries
         self._y_offset = y_offset
-        # Prerender the menu as if we have unlimited rows
-        self._full_menu = _RenderFullMenu(font, line_w, line_h, entries)
+        self._last_draw = None
+        self._full_menu = _MakeFullMenu(
+            font, line_w, line_h, entries, virtual, cache_rows)
+        self._view = self._full_menu
 
     def _lineToEntryIndex(self, active_index, n):
         start = (int(active_index) // self._num_rows) * self._num_rows
@@ -48,26 +491,35 @@ class Menu(object):
     def _ActiveLine(self):
         return self.active_entry_index % self._num_rows
 
-    def draw(self, active_index: float, canvas: ImageDraw):
+    def draw(self, active_index: float, canvas: ImageDraw, damage=False):
         """Draw the menu into a canvas.
         `active_index` can be a float for smooth transitions
+        If `damage` is True, the list of rectangles that changed
+        since the previous draw is returned. This assumes the canvas
+        area is cleared before each draw.
         """
         # copy the relevant part of the pre-rendered menu
         y_start = self._y_offset + \
             self._lineToEntryIndex(active_index, 0) * self._line_h
         rect = (0, y_start,
                 self._line_w, y_start + self._num_rows * self._line_h)
-        visible = self._full_menu.crop(rect)
-        canvas.bitmap((0, 0), visible, fill="white")
-        # then draw the active menu frame
+        visible = self._view.crop(rect)
+        # then draw the active menu frame - while moving past the last
+        # row it extends below the visible rows
         n = active_index % self._num_rows
-        canvas.rectangle((0, int(n * self._line_h),
-                          self._line_w - 1,
-                          int((n + 1) * self._line_h - 1)),
-                         outline="white")
+        frame_top = int(n * self._line_h)
+        frame_bottom = int((n + 1) * self._line_h - 1)
+        out = visible
+        if frame_bottom >= visible.size[1]:
+            out = Image.new("1", (self._line_w, frame_bottom + 1))
+            out.paste(visible, (0, 0))
+        ImageDraw.Draw(out).rectangle((0, frame_top,
+                                       self._line_w - 1, frame_bottom),
+                                      outline="white")
+        return self._Show(canvas, (0, 0), out, damage)
 
 
-class MenuCentered(object):
+class MenuCentered(_MenuBase):
     """Simple menu helper
     `font`: font to draw the menu enriess with
     'num_rows`: how many rows are visible - must be odd
@@ -75,9 +527,11 @@ class MenuCentered(object):
     `entries`: text of menu entries to be show - add space to end to avoid drawing bug
     `y_center' center y coordinate of the screen
     `y_offset`: font dependent fudge offset. Try small integers starting with zero.
+    `virtual`, `cache_rows`: see Menu
     """
 
-    def __init__(self, font, num_rows, line_w, line_h, entries, active_entry_index, y_center, y_offset):
+    def __init__(self, font, num_rows, line_w, line_h, entries, active_entry_index, y_center, y_offset,
+                 virtual=False, cache_rows=_CACHE_ROWS):
         assert num_rows & 1 == 1
         self._font = font
         self._num_rows = num_rows
@@ -86,16 +540,19 @@ class MenuCentered(object):
         self.entries = entries
         self._y_offset = y_offset
         self._y_center = y_center
-        # Prerender the menu as if we have unlimited rows
-        self._full_menu = _RenderFullMenu(font, line_w, line_h, entries)
+        self._last_draw = None
+        self._full_menu = _MakeFullMenu(
+            font, line_w, line_h, entries, virtual, cache_rows)
+        self._view = self._full_menu
 
     def _lineToEntryIndex(self, n):
         start = (self.active_entry_index // self._num_rows) * self._num_rows
         return n + start
 
-    def draw(self, active_index: float, canvas: ImageDraw):
+    def draw(self, active_index: float, canvas: ImageDraw, damage=False):
         """Draw the menu into a canvas.
         `active_index` can be a float for smooth transitions
+        `damage`: see Menu.draw
         """
         # copy the relevant part of the pre-rendered menu
         y_middle = int(active_index * self._line_h + self._line_h // 2)
@@ -103,13 +560,20 @@ class MenuCentered(object):
         y_end = int((active_index + 1 + self._num_rows // 2) * self._line_h)
         rect = (0, self._y_offset + y_start,
                 self._line_w, self._y_offset + y_end)
-        visible = self._full_menu.crop(rect)
-        canvas.bitmap((0, self._y_center - (y_middle - y_start)),
-                      visible, fill="white")
+        visible = self._view.crop(rect)
+        # the active menu frame extends slightly beyond the visible rows
+        top = self._y_center - (y_middle - y_start)
+        frame_top = self._y_center - 1 - self._line_h // 2
+        frame_bottom = self._y_center + 1 + self._line_h // 2
+        y0 = min(top, frame_top)
+        y1 = max(top + visible.size[1], frame_bottom + 1)
+        out = Image.new("1", (self._line_w, y1 - y0))
+        out.paste(visible, (0, top - y0))
         # then draw the active menu frame
-        canvas.rectangle((0, self._y_center - 1 - self._line_h // 2,
-                          self._line_w - 1, self._y_center + 1 + self._line_h // 2),
-                         outline="white")
+        ImageDraw.Draw(out).rectangle((0, frame_top - y0,
+                                       self._line_w - 1, frame_bottom - y0),
+                                      outline="white")
+        return self._Show(canvas, (0, y0), out, damage)
 
 
 if __name__ == "__main__":
@@ -147,6 +611,33 @@ if __name__ == "__main__":
     FONT_H = 16
     cwd = os.path.dirname(__file__)
     FONT = ImageFont.truetype(cwd + "/Fonts/code2000.ttf", FONT_H)
+
+    def Benchmark(num_entries):
+        entries = ["%05d entry " % i for i in range(num_entries)]
+        for virtual in [False, True]:
+            start = time.time()
+            m = Menu(FONT, H // FONT_H, W, FONT_H, entries, 0, 3,
+                     virtual=virtual)
+            stop = time.time()
+            print("entries: %d virtual: %s construction msec: %.1f" %
+                  (num_entries, virtual, 1000.0 * (stop - start)))
+        image = Image.new("1", (W, H))
+        draw = ImageDraw.Draw(image)
+        for i in range(num_entries):
+            m.draw(i, draw)
+        print("virtual stats", m.stats())
+        start = time.time()
+        entry_filter = EntryFilter(entries)
+        print("filter index msec: %.1f" % (1000.0 * (time.time() - start)))
+        for c in "123":
+            start = time.time()
+            n = entry_filter.push(c)
+            print("filter [%s] matches: %d msec: %.3f" %
+                  (entry_filter.query(), n, 1000.0 * (time.time() - start)))
+        m.set_filter(entry_filter.matches())
+        m.draw(0, draw)
+
+    Benchmark(5000)
     #menu = Menu(FONT, H // FONT_H, W,  FONT_H, _ENTRIES, 0, 3)
     menu = MenuCentered(FONT, H // FONT_H - 1, W,  FONT_H, _ENTRIES, 0, 32, 3)
     image = Image.new("1", (W, H))
@@ -6,60 +6,353 @@ https://www.amazon.com/gp/product/B07DM2YMT4
 
 The rotary encoder has three pins. The middle one
 needs to be connected to GND the others to arbitray GPIO pins.
+
+Demo:
+./rotary_encoder.py
+./rotary_encoder.py queued
+
+Test (no hardware needed):
+./rotary_encoder.py test
 """
 
-import RPi.GPIO as GPIO
+import collections
+import threading
+import time
+
+# RPi.GPIO is only needed by RotarySwitch (not for the decoder)
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    GPIO = None
+
+_INVALID = None
+
+# quadrature state is (a << 1) | b
+# index is (old_state << 2) | new_state, value is the quarter step
+# direction or _INVALID if both pins changed (a transition was missed)
+_TRANSITIONS = [
+    0, -1, 1, _INVALID,
+    1, 0, _INVALID, -1,
+    -1, _INVALID, 0, 1,
+    _INVALID, 1, -1, 0,
+]
+
+# states where the switch rests between detents
+_REST_STATES = {
+    1: {0, 1, 2, 3},
+    2: {0, 3},
+    4: {3},
+}
+
+
+class QuadratureDecoder(object):
+    """Hardware independent quadrature decoder
+
+    Feed it the pin levels after every edge of either pin via Edge()
+    which returns the number of (accelerated) detents moved:
+    positive for right, negative for left.
+
+    `steps_per_detent`: quarter steps between two rest positions (1, 2, 4)
+    `acceleration`: optional list of (detents_per_sec, multiplier) - the
+        multiplier of the highest matching rate is applied to each detent
+    `velocity_smoothing`: weight of the newest interval in the velocity
+        estimate
+    """
+
+    def __init__(self, steps_per_detent=4, acceleration=None,
+                 velocity_smoothing=0.3, a=True, b=True):
+        self._rest = _REST_STATES[steps_per_detent]
+        self._threshold = max(1, steps_per_detent // 2)
+        self._acceleration = sorted(acceleration or [])
+        self._smoothing = velocity_smoothing
+        self._state = int(a) << 1 | int(b)
+        self._count = 0
+        self._last_detent = None
+        # detents per sec, signed
+        self.velocity = 0.0
+        self.transitions = 0
+        self.invalid = 0
+        self.detents = 0
+
+    def _Multiplier(self):
+        m = 1
+        for rate, multiplier in self._acceleration:
+            if abs(self.velocity) >= rate:
+                m = multiplier
+        return m
+
+    def _UpdateVelocity(self, direction, t):
+        if self._last_detent is not None:
+            dt = t - self._last_detent
+            if dt > 0:
+                v = direction / dt
+                if (v > 0) != (self.velocity > 0) or dt > 0.5:
+                    # direction change or pause: start from scratch
+                    self.velocity = v
+                else:
+                    self.velocity += self._smoothing * (v - self.velocity)
+        self._last_detent = t
+
+    def Edge(self, a, b, t=None):
+        state = int(a) << 1 | int(b)
+        if state == self._state:
+            return 0
+        step = _TRANSITIONS[self._state << 2 | state]
+        self._state = state
+        if step is _INVALID:
+            self.invalid += 1
+            return 0
+        self.transitions += 1
+        self._count += step
+        if state not in self._rest:
+            return 0
+        count = self._count
+        self._count = 0
+        if abs(count) < self._threshold:
+            return 0
+        direction = 1 if count > 0 else -1
+        self._UpdateVelocity(direction, time.time() if t is None else t)
+        self.detents += 1
+        return direction * self._Multiplier()
+
+    def stats(self):
+        return {
+            "transitions": self.transitions,
+            "invalid": self.invalid,
+            "detents": self.detents,
+            "velocity": self.velocity,
+        }
+
+
+class MovementQueue(object):
+    """Decouples edge handling from a slow consumer
+
+    The producer (GPIO event thread) only appends deltas to a deque,
+    which needs no lock in CPython. The consumer gets the net movement
+    of all deltas queued since its last call, e.g. +5 instead of five
+    separate events.
+
+    `maxlen`: when full a new delta is merged into the newest queued
+        one (and counted) so no movement is lost
+    `notify`: optional function called after each Put, e.g. to wake up
+        a main loop which polls with Get(0)
+    """
+
+    def __init__(self, maxlen=256, notify=None):
+        self._maxlen = maxlen
+        self._notify = notify
+        self._deltas = collections.deque()
+        self._ready = threading.Event()
+        self.received = 0
+        self.coalesced = 0
+        self.merged = 0
+
+    def Put(self, delta):
+        self.received += 1
+        if len(self._deltas) >= self._maxlen:
+            # pop() and popleft() are atomic, so the tail is ours unless
+            # the consumer just emptied the deque
+            try:
+                delta += self._deltas.pop()
+                self.merged += 1
+            except IndexError:
+                pass
+        self._deltas.append(delta)
+        self._ready.set()
+        if self._notify is not None:
+            self._notify()
+
+    def Get(self, timeout=None):
+        """Returns the net movement, 0 on timeout"""
+        if not self._ready.wait(timeout):
+            return 0
+        self._ready.clear()
+        total = 0
+        n = 0
+        while True:
+            try:
+                total += self._deltas.popleft()
+            except IndexError:
+                break
+            n += 1
+        if n > 1:
+            self.coalesced += n - 1
+        return total
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "coalesced": self.coalesced,
+            "merged": self.merged,
+        }
 
 
 class RotarySwitch(object):
-    """ 
-    Note, this works better than everything else I tried and does not
-    rely on debouncing. It is still not perfect especially when the
-    switch is tuned rapidly.
+    """
+    Listens to both edges on both pins and decodes them with a
+    QuadratureDecoder, so fast turns do not lose steps.
 
     The callback will be called with True or False depending on the
-    direction the switch is turned.
+    direction the switch is turned (once per detent, more often when
+    `acceleration` kicks in - see QuadratureDecoder).
+
+    With `queued` the GPIO event thread only puts deltas into the
+    MovementQueue `events`. The callback (if any) is then called on a
+    separate thread with the net movement (an int, positive for right)
+    so a slow callback cannot delay edge handling. Without a callback
+    the consumer reads `events` itself (`notify` is passed on to the
+    MovementQueue) - only allowed with `queued`.
 
     pina, pinb can be arbitrary GPIO pins
     """
 
-    def __init__(self, pina, pinb, callback):
+    def __init__(self, pina, pinb, callback=None, steps_per_detent=4,
+                 acceleration=None, queued=False, queue_len=256,
+                 notify=None):
+        if callback is None and not queued:
+            raise ValueError("RotarySwitch needs a callback unless queued")
         self._pina = pina
         self._pinb = pinb
         self._callback = callback
-        self._vala = False
-        self._valb = False
+        self.events = None
+        if queued:
+            self.events = MovementQueue(queue_len, notify)
+            if callback is not None:
+                threading.Thread(target=self._Dispatcher, daemon=True).start()
 
         GPIO.setup(pina, GPIO.IN, pull_up_down=GPIO.PUD_UP)
         GPIO.setup(pinb, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.add_event_detect(pina, GPIO.RISING, callback=self._trigger)
-        GPIO.add_event_detect(pinb, GPIO.RISING, callback=self._trigger)
+        self.decoder = QuadratureDecoder(
+            steps_per_detent, acceleration,
+            a=GPIO.input(pina), b=GPIO.input(pinb))
+        GPIO.add_event_detect(pina, GPIO.BOTH, callback=self._trigger)
+        GPIO.add_event_detect(pinb, GPIO.BOTH, callback=self._trigger)
 
     def _trigger(self, _pin):
-        vala = GPIO.input(self._pina)
-        valb = GPIO.input(self._pinb)
-        if not vala and not valb:
-            # time.sleep(0.01)
+        delta = self.decoder.Edge(GPIO.input(self._pina),
+                                  GPIO.input(self._pinb))
+        if delta == 0:
             return
-        if vala == self._vala and valb == self._valb:
-            # time.sleep(0.01)
-            # print("ignore dups")
+        if self.events is not None:
+            self.events.Put(delta)
             return
-        if vala != valb and vala == self._valb and valb == self._vala:
-            self._callback(vala)
-            vala = True
-            valb = True
+        for _ in range(abs(delta)):
+            self._callback(delta > 0)
+
+    def _Dispatcher(self):
+        while True:
+            delta = self.events.Get()
+            if delta:
+                self._callback(delta)
 
-        self._valb = valb
-        self._vala = vala
+    def stats(self):
+        out = self.decoder.stats()
+        if self.events is not None:
+            out.update(self.events.stats())
+        return out
 
 
 if __name__ == "__main__":
-    import time
+    import sys
+
+    # quadrature sequence for one detent to the right starting at rest
+    _RIGHT = [(0, 1), (0, 0), (1, 0), (1, 1)]
+
+    def _Feed(decoder, seq, t0, dt):
+        total = 0
+        for n, (a, b) in enumerate(seq):
+            total += decoder.Edge(a, b, t0 + n * dt)
+        return total
+
+    def test():
+        decoder = QuadratureDecoder()
+        assert _Feed(decoder, _RIGHT * 10, 0.0, 0.01) == 10
+        assert _Feed(decoder, _RIGHT[::-1][1:] + [(1, 1)], 1.0, 0.01) == -1
+        # contact bounce between two states does not move
+        assert _Feed(decoder, [(0, 1), (1, 1)] * 5, 2.0, 0.001) == 0
+        # a missed transition is rejected but the detent still counts
+        decoder = QuadratureDecoder()
+        assert _Feed(decoder, [(0, 1), (1, 0), (1, 1)], 0.0, 0.001) == 1
+        assert decoder.invalid == 1
+
+        # 2000 detents at 500 detents/sec (8000 edges/sec) with
+        # simulated edge jitter
+        import random
+        rnd = random.Random(1)
+        decoder = QuadratureDecoder()
+        total = 0
+        t = 0.0
+        start = time.time()
+        for i in range(2000 * 4):
+            t += 0.0005 * rnd.uniform(0.2, 1.8)
+            a, b = _RIGHT[i % 4]
+            total += decoder.Edge(a, b, t)
+        elapsed = time.time() - start
+        print("fast spin", total, decoder.stats(),
+              "usec/edge: %.2f" % (1000000.0 * elapsed / 8000))
+        assert total == 2000
+
+        # acceleration: a fast spin moves further than a slow one
+        accel = [(20, 2), (50, 5)]
+        slow = _Feed(QuadratureDecoder(acceleration=accel), _RIGHT * 10,
+                     0.0, 0.05)
+        fast = _Feed(QuadratureDecoder(acceleration=accel), _RIGHT * 10,
+                     0.0, 0.002)
+        print("slow", slow, "fast", fast)
+        assert slow == 10 and fast > 30
+
+        # a slow consumer gets the net movement of a fast producer
+        queue = MovementQueue()
+        seen = []
+
+        def consumer():
+            while sum(seen) != 800:
+                seen.append(queue.Get(1.0))
+                time.sleep(0.01)
+
+        thread = threading.Thread(target=consumer)
+        thread.start()
+        for i in range(1000):
+            queue.Put(1 if i % 10 else -1)
+            time.sleep(0.0001)
+        thread.join()
+        print("queue", queue.stats(), "deliveries", len(seen))
+        assert queue.merged == 0 and len(seen) < 100
+
+        # a full queue merges into the newest delta instead of dropping
+        queue = MovementQueue(maxlen=4)
+        for delta in [1, 1, 1, 1, 2, -1, 3]:
+            queue.Put(delta)
+        print("full queue", queue.stats())
+        assert queue.merged == 3 and queue.Get(0) == 8
+
+        # edges would have nowhere to go (checked before touching GPIO)
+        try:
+            RotarySwitch(10, 8)
+        except ValueError:
+            pass
+        else:
+            assert False, "RotarySwitch without callback or queue"
+
+    def main():
+        def _example_callback(right):
+            print("right" if right else "left")
+
+        def _slow_callback(delta):
+            print("moved", delta)
+            # simulate an expensive redraw
+            time.sleep(0.2)
 
-    def _example_callback(right):
-        print("right" if right else "left")
+        GPIO.setmode(GPIO.BOARD)  # Numbers GPIOs by physical location
+        if len(sys.argv) > 1 and sys.argv[1] == "queued":
+            rotary = RotarySwitch(10, 8, _slow_callback, queued=True)
+        else:
+            rotary = RotarySwitch(10, 8, _example_callback,
+                                  acceleration=[(20, 2), (50, 5)])
+        time.sleep(100)
+        print(rotary.stats())
 
-    GPIO.setmode(GPIO.BOARD)  # Numbers GPIOs by physical location
-    rotary = RotarySwitch(10, 8, _example_callback)
-    time.sleep(100)
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        test()
+    else:
+        main()
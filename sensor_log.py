@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Compact append-only log for sensor time series
+
+Records are fixed size: a float64 timestamp followed by the values
+described by `fields`, e.g. [("x", "i2"), ("y", "i2"), ("z", "i2")]
+for raw gyro readings or [("temp", "f4"), ("pressure", "f4")] for
+compensated values. Field types use numpy notation (little endian).
+
+Records are appended to segment files <name>-<seq>.log in a directory.
+Each segment starts with a small header describing the fields.
+After a power loss partial trailing records are truncated when the
+log is opened for writing again.
+
+The reader memory-maps the segments and returns numpy views, nothing
+is parsed. Timestamps are assumed to be increasing.
+
+Demo/Test/Benchmark:
+./sensor_log.py
+
+Dependencies (reader only):
+pip3 install numpy
+"""
+
+import glob
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import time
+
+# numpy is only needed by SensorLogReader
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_MAGIC = b"PTXLOG1\0"
+# magic, header size
+_PREFIX = struct.Struct("<8sI")
+_HEADER_ALIGN = 64
+
+_STRUCT_CODES = {
+    "i1": "b", "u1": "B", "i2": "h", "u2": "H", "i4": "i", "u4": "I",
+    "i8": "q", "u8": "Q", "f4": "f", "f8": "d",
+}
+
+
+def _RecordStruct(fields):
+    return struct.Struct("<d" + "".join(_STRUCT_CODES[t] for _, t in fields))
+
+
+def _MakeHeader(fields):
+    meta = json.dumps({"fields": [list(f) for f in fields]}).encode("utf-8")
+    size = _PREFIX.size + len(meta)
+    size = (size + _HEADER_ALIGN - 1) // _HEADER_ALIGN * _HEADER_ALIGN
+    return (_PREFIX.pack(_MAGIC, size) + meta).ljust(size, b"\0")
+
+
+def _ReadHeader(fp):
+    """Returns (header size, fields) or None if the header is damaged"""
+    prefix = fp.read(_PREFIX.size)
+    if len(prefix) < _PREFIX.size:
+        return None
+    magic, size = _PREFIX.unpack(prefix)
+    if magic != _MAGIC:
+        return None
+    meta = fp.read(size - _PREFIX.size)
+    if len(meta) < size - _PREFIX.size:
+        return None
+    fields = json.loads(meta.rstrip(b"\0").decode("utf-8"))["fields"]
+    return size, [tuple(f) for f in fields]
+
+
+def _Segments(directory, name):
+    """Returns the segment files of a log ordered by sequence number"""
+    pattern = re.compile(re.escape(name) + r"-(\d+)\.log$")
+    out = []
+    for path in glob.glob(os.path.join(directory, glob.escape(name) + "-*.log")):
+        m = pattern.search(os.path.basename(path))
+        if m:
+            out.append((int(m.group(1)), path))
+    out.sort()
+    return out
+
+
+def _RepairSegment(path, fields):
+    """Drops damaged segments and truncates partial trailing records"""
+    with open(path, "rb") as fp:
+        header = _ReadHeader(fp)
+    if header is None or header[1] != fields:
+        if header is None:
+            logging.warning("removing damaged log segment [%s]", path)
+            os.remove(path)
+        return
+    header_size, _ = header
+    record_size = _RecordStruct(fields).size
+    size = os.path.getsize(path)
+    excess = (size - header_size) % record_size
+    if excess:
+        logging.warning("truncating %d bytes of partial record in [%s]",
+                        excess, path)
+        with open(path, "r+b") as fp:
+            fp.truncate(size - excess)
+            os.fsync(fp.fileno())
+
+
+class SensorLogWriter:
+    """Appends fixed size records to segment files
+
+    `segment_records`: number of records before starting a new segment
+    `sync_interval`: secs between fsyncs - data written since the last
+    fsync may be lost on power loss
+    """
+
+    def __init__(self, directory, name, fields, segment_records=1 << 20,
+                 sync_interval=5.0, buffer_size=1 << 16):
+        self._directory = directory
+        self._name = name
+        self._fields = [tuple(f) for f in fields]
+        self._struct = _RecordStruct(self._fields)
+        self.record_size = self._struct.size
+        self._header = _MakeHeader(self._fields)
+        self._segment_records = segment_records
+        self._sync_interval = sync_interval
+        self._buffer_size = buffer_size
+        self._fp = None
+        self._count = 0
+        self._last_sync = time.time()
+        self._syncs = 0
+        self._records = 0
+        os.makedirs(directory, exist_ok=True)
+        segments = _Segments(directory, name)
+        if segments:
+            _RepairSegment(segments[-1][1], self._fields)
+        self._seq = segments[-1][0] + 1 if segments else 0
+        self._NewSegment()
+
+    def _NewSegment(self):
+        self._Close()
+        path = os.path.join(self._directory, "%s-%06d.log" %
+                            (self._name, self._seq))
+        self._seq += 1
+        self._fp = open(path, "wb", buffering=self._buffer_size)
+        self._fp.write(self._header)
+        self._count = 0
+
+    def _Close(self):
+        if self._fp is not None:
+            self.Sync()
+            self._fp.close()
+            self._fp = None
+
+    def _Written(self, n):
+        self._count += n
+        self._records += n
+        if self._count >= self._segment_records:
+            self._NewSegment()
+        elif time.time() - self._last_sync >= self._sync_interval:
+            self.Sync()
+
+    def Append(self, timestamp, *values):
+        self._fp.write(self._struct.pack(timestamp, *values))
+        self._Written(1)
+
+    def AppendRecords(self, data):
+        """Appends already packed records, e.g. numpy_array.tobytes()
+        with a dtype matching SensorLogReader.dtype
+        """
+        n, rest = divmod(len(data), self.record_size)
+        assert rest == 0
+        view = memoryview(data).cast("B")
+        while n > 0:
+            k = min(n, self._segment_records - self._count)
+            self._fp.write(view[:k * self.record_size])
+            view = view[k * self.record_size:]
+            n -= k
+            self._Written(k)
+
+    def Sync(self):
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        self._last_sync = time.time()
+        self._syncs += 1
+
+    def Close(self):
+        self._Close()
+
+    def stats(self):
+        return {"records": self._records, "syncs": self._syncs,
+                "segment": self._seq - 1}
+
+
+class _Segment:
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fp:
+            header = _ReadHeader(fp)
+            if header is None:
+                raise ValueError("bad log segment header: " + path)
+            self.header_size, self.fields = header
+            size = os.fstat(fp.fileno()).st_size
+            self.mm = None
+            if size > self.header_size:
+                self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = size
+
+    def Records(self, dtype):
+        if self.mm is None:
+            return numpy.zeros(0, dtype=dtype)
+        # ignore a partial record still being written
+        n = (self.size - self.header_size) // dtype.itemsize
+        return numpy.frombuffer(self.mm, dtype=dtype, count=n,
+                                offset=self.header_size)
+
+
+class SensorLogReader:
+    """Time range queries over a log written by SensorLogWriter"""
+
+    def __init__(self, directory, name):
+        self._directory = directory
+        self._name = name
+        self._segments = {}
+        self._fields = None
+        self.dtype = None
+        self.Refresh()
+
+    def Refresh(self):
+        """Picks up new segments and data appended since the last call"""
+        segments = {}
+        for _, path in _Segments(self._directory, self._name):
+            seg = self._segments.get(path)
+            if seg is None or seg.size != os.path.getsize(path):
+                try:
+                    seg = _Segment(path)
+                except ValueError as err:
+                    logging.warning("%s", err)
+                    continue
+            if self._fields is None:
+                self._fields = seg.fields
+                self.dtype = numpy.dtype(
+                    [("t", "<f8")] + [(n, "<" + t) for n, t in seg.fields])
+            elif seg.fields != self._fields:
+                logging.warning("skipping segment with different fields [%s]",
+                                path)
+                continue
+            segments[path] = seg
+        self._segments = segments
+
+    def Query(self, start, end):
+        """Returns a list of numpy views (one per segment) of the
+        records with start <= timestamp < end
+        """
+        out = []
+        for seg in self._segments.values():
+            records = seg.Records(self.dtype)
+            if len(records) == 0:
+                continue
+            ts = records["t"]
+            if ts[-1] < start or ts[0] >= end:
+                continue
+            lo = numpy.searchsorted(ts, start, side="left")
+            hi = numpy.searchsorted(ts, end, side="left")
+            if hi > lo:
+                out.append(records[lo:hi])
+        return out
+
+    def QueryArray(self, start, end):
+        """Like Query but returns a single array (this copies)"""
+        views = self.Query(start, end)
+        if not views:
+            return numpy.zeros(0, dtype=self.dtype)
+        return numpy.concatenate(views)
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    def main():
+        logging.basicConfig(level=logging.INFO)
+        directory = tempfile.mkdtemp()
+        fields = [("x", "i2"), ("y", "i2"), ("z", "i2")]
+        n = 200000
+        writer = SensorLogWriter(directory, "gyro", fields,
+                                 segment_records=50000, sync_interval=0.5)
+        start = time.time()
+        for i in range(n):
+            writer.Append(i / 1000.0, i & 0x7fff, -(i & 0x7fff), 7)
+        stop = time.time()
+        print("append records/s: %.0f" % (n / (stop - start)), writer.stats())
+        writer.Close()
+
+        # simulate a power loss in the middle of a record
+        path = _Segments(directory, "gyro")[-1][1]
+        with open(path, "ab") as fp:
+            fp.write(b"\1\2\3")
+        writer = SensorLogWriter(directory, "gyro", fields)
+        writer.Append(n / 1000.0, 1, 2, 3)
+        writer.Close()
+
+        reader = SensorLogReader(directory, "gyro")
+        start = time.time()
+        views = reader.Query(10.0, 120.0)
+        stop = time.time()
+        total = sum(len(v) for v in views)
+        print("query usec: %.1f records: %d segments: %d" %
+              (1000000.0 * (stop - start), total, len(views)))
+        assert total == 110000
+        assert views[0]["t"][0] == 10.0
+        last = reader.QueryArray(n / 1000.0, n / 1000.0 + 1)
+        assert len(last) == 1 and last["z"][0] == 3
+
+    main()
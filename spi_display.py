@@ -153,6 +153,21 @@ def _SSD1306_FramebufferUpdateDataXXX(w, h, image: Image):
     return out
 
 
+def _DirtyPages(rects, h):
+    """Returns the sorted and merged (first, last) ranges of 8 pixel row
+    display pages touched by the rectangles (x0, y0, x1, y1) in `rects`
+    """
+    pages = sorted((max(0, y0) // 8, (min(h, y1) - 1) // 8)
+                   for _, y0, _, y1 in rects if y1 > y0 and y1 > 0 and y0 < h)
+    out = []
+    for first, last in pages:
+        if out and first <= out[-1][1] + 1:
+            out[-1] = (out[-1][0], max(last, out[-1][1]))
+        else:
+            out.append((first, last))
+    return out
+
+
 _SSD1306_SETTINGS = {
     (128, 64): dict(multiplex=0x3F, displayclockdiv=0x80, compins=0x12),
     (128, 32): dict(multiplex=0x1F, displayclockdiv=0x80, compins=0x02),
@@ -173,6 +188,7 @@ class SSD1306(object):
         settings = _SSD1306_SETTINGS.get((w, h))
         colstart = (0x80 - w) // 2
         pages = h // 8
+        self._colstart = colstart
         self._update_cmd = bytes([
             COLUMNADDR, colstart, colstart + w - 1,
             PAGEADDR, 0, pages - 1,
@@ -196,10 +212,24 @@ class SSD1306(object):
         ])
         self._dev.write_cmd(init_cmd)
 
-    def show(self, image: Image):
-        data = _SSD1306_FramebufferUpdateData(self._w, self._h, image)
-        self._dev.write_cmd(self._update_cmd)
-        self._dev.write_data(data)
+    def show(self, image: Image, rects=None):
+        """`rects`: optional list of changed rectangles, e.g. from
+        Menu.draw(damage=True). Only the display pages touched are sent.
+        """
+        if rects is None:
+            data = _SSD1306_FramebufferUpdateData(self._w, self._h, image)
+            self._dev.write_cmd(self._update_cmd)
+            self._dev.write_data(data)
+            return
+        colstart = self._colstart
+        for first, last in _DirtyPages(rects, self._h):
+            band = image.crop((0, first * 8, self._w, (last + 1) * 8))
+            data = _SSD1306_FramebufferUpdateData(self._w, band.size[1], band)
+            self._dev.write_cmd(bytes([
+                COLUMNADDR, colstart, colstart + self._w - 1,
+                PAGEADDR, first, last,
+            ]))
+            self._dev.write_data(data)
 
     def on(self):
         self._dev.write_cmd(bytes([DISPLAYON]))
@@ -314,14 +344,22 @@ class SH1106(object):
         ])
         self._dev.write_cmd(init_cmd)
 
-    def show(self, image: Image):
-        data = _SH1106_FramebufferUpdateData(image)
-        page_size_bytes = image.size[0]
-        update_cmd = bytearray([0xB0, 0x02, 0x10])
-        for i in range(0, len(data), page_size_bytes):
-            self._dev.write_cmd(bytes(update_cmd))
-            update_cmd[0] += 1
-            self._dev.write_data(data[i:i + page_size_bytes])
+    def show(self, image: Image, rects=None):
+        """`rects`: see SSD1306.show"""
+        w, h = image.size
+        page_size_bytes = w
+        if rects is None:
+            ranges = [(0, h // 8 - 1)]
+        else:
+            ranges = _DirtyPages(rects, h)
+        for first, last in ranges:
+            data = _SH1106_FramebufferUpdateData(
+                image.crop((0, first * 8, w, (last + 1) * 8)))
+            update_cmd = bytearray([0xB0 + first, 0x02, 0x10])
+            for i in range(0, len(data), page_size_bytes):
+                self._dev.write_cmd(bytes(update_cmd))
+                update_cmd[0] += 1
+                self._dev.write_data(data[i:i + page_size_bytes])
 
     def on(self):
         self._dev.write_cmd(bytes([DISPLAYON]))
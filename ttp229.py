@@ -3,7 +3,12 @@
 # cf.: https://www.elecrow.com/download/TOUCH_IC_TTP229.pdf
 # This is a simple i2c device that does not require writing registers
 
+import collections
+import logging
 import os
+import queue
+import threading
+import time
 from fcntl import ioctl
 
 # https://elinux.org/Interfacing_with_I2C_Devic
@@ -23,10 +28,19 @@ I2C_SMBUS = 0x0720  # SMBus transfer. Takes pointer to i2c_smbus_ioctl_data
 
 
 class SensorTTP229:
+    """
+    `bus`: optional shared bus like i2c_bus.I2CBus (needs a read_raw
+    method). Otherwise /dev/i2c-<bus_no> is opened exclusively.
+    """
 
-    def __init__(self, bus_no=1, addr=0x57):
-        self._fd = os.open("/dev/i2c-%d" % bus_no, os.O_RDWR)
+    def __init__(self, bus_no=1, addr=0x57, bus=None):
+        self._bus = bus
+        self._fd = None
         self._addr = addr
+        if bus is None:
+            self._fd = os.open("/dev/i2c-%d" % bus_no, os.O_RDWR)
+            # the slave address is per fd, so this only needs to be done once
+            self.set_address()
 
     def close(self):
         if self._fd:
@@ -37,19 +51,189 @@ class SensorTTP229:
         ioctl(self._fd, I2C_SLAVE, self._addr)
 
     def KeyStatus(self):
-        self.set_address()
-        a = os.read(self._fd, 2)
+        if self._bus is not None:
+            a = self._bus.read_raw(self._addr, 2)
+        else:
+            a = os.read(self._fd, 2)
         return a[0] * 256 + a[1]
 
 
+EVENT_PRESS = "press"
+EVENT_RELEASE = "release"
+EVENT_LONG_PRESS = "long_press"
+EVENT_REPEAT = "repeat"
+
+# `key` is the bit number in the KeyStatus mask
+KeyEvent = collections.namedtuple("KeyEvent", ["kind", "key", "time"])
+
+
+class KeypadReader:
+    """Polls a SensorTTP229 on a background thread and turns mask
+    changes into KeyEvents
+
+    `callback`: called with each KeyEvent on the reader thread. If None
+        events are put into the queue `events` instead.
+    `fast_hz`: poll rate while keys are held or were recently active
+    `idle_hz`: poll rate after `idle_after` secs without activity.
+        The ttp229 has no interrupt line so this bounds the latency of
+        the first press: worst case one period plus about two reads
+        (the period starts when a read ends). The default of 60 Hz
+        (16.7 ms) leaves room for the reads and wakeup jitter to stay
+        under 20 ms - at 50 Hz the period alone is 20 ms. Each wakeup is
+        one short i2c read. Lower it if a slower response is
+        acceptable, e.g. 10 Hz for about 100 ms.
+    `debounce`: secs after an edge during which further changes of
+        the same key are ignored (edges are reported without delay)
+    `long_press`: secs a key must be held for EVENT_LONG_PRESS
+    `repeat`: secs between EVENT_REPEATs after a long press (None = off)
+    """
+
+    def __init__(self, sensor, callback=None, fast_hz=100.0, idle_hz=60.0,
+                 idle_after=2.0, debounce=0.03, long_press=0.8, repeat=0.2):
+        self._sensor = sensor
+        self._callback = callback
+        self.events = queue.Queue()
+        self._fast_period = 1.0 / fast_hz
+        self._idle_period = 1.0 / idle_hz
+        self._idle_after = idle_after
+        self._debounce = debounce
+        self._long_press = long_press
+        self._repeat = repeat
+        # debounced mask
+        self._mask = 0
+        self._lockout = {}
+        # key -> [time of the next long press/repeat event, repeating]
+        self._held = {}
+        self._last_activity = 0.0
+        self._thread = None
+        self._stop = threading.Event()
+        self._polls = 0
+        self._poll_time = 0.0
+        self._counts = collections.Counter()
+        self._errors = 0
+
+    def _Emit(self, kind, key, now):
+        self._counts[kind] += 1
+        event = KeyEvent(kind, key, now)
+        if self._callback is None:
+            self.events.put(event)
+            return
+        try:
+            self._callback(event)
+        except Exception:
+            logging.exception("keypad callback failed")
+
+    def Poll(self, now=None):
+        """Read the sensor once and emit events (called by the reader
+        thread but can also be driven manually)
+        """
+        if now is None:
+            now = time.time()
+        mask = self._sensor.KeyStatus()
+        self._polls += 1
+        changed = mask ^ self._mask
+        while changed:
+            bit = changed & -changed
+            changed ^= bit
+            key = bit.bit_length() - 1
+            if now < self._lockout.get(key, 0.0):
+                continue
+            self._lockout[key] = now + self._debounce
+            self._mask ^= bit
+            self._last_activity = now
+            if mask & bit:
+                self._held[key] = [now + self._long_press, False]
+                self._Emit(EVENT_PRESS, key, now)
+            else:
+                self._held.pop(key, None)
+                self._Emit(EVENT_RELEASE, key, now)
+        for key, state in self._held.items():
+            due, repeating = state
+            if due is None or now < due:
+                continue
+            self._last_activity = now
+            self._Emit(EVENT_REPEAT if repeating else EVENT_LONG_PRESS,
+                       key, now)
+            state[0] = None if self._repeat is None else now + self._repeat
+            state[1] = True
+
+    def _Period(self):
+        if self._held or time.time() - self._last_activity < self._idle_after:
+            return self._fast_period
+        return self._idle_period
+
+    def _Reader(self):
+        while not self._stop.wait(self._Period()):
+            start = time.time()
+            try:
+                self.Poll(start)
+            except Exception:
+                self._errors += 1
+                logging.exception("keypad poll failed")
+            self._poll_time += time.time() - start
+
+    def Start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._Reader, daemon=True)
+        self._thread.start()
+
+    def Stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        return {
+            "polls": self._polls,
+            "poll_time": self._poll_time,
+            "poll_hz": 1.0 / self._Period(),
+            "errors": self._errors,
+            "events": dict(self._counts),
+        }
+
+
 if __name__ == "__main__":
-    import time
+    import sys
 
     def main():
         sensor = SensorTTP229()
-        for i in range(1000):
-            print ("%04x" % sensor.KeyStatus())
+        reader = KeypadReader(sensor, callback=print)
+        reader.Start()
+        time.sleep(60)
+        reader.Stop()
+        print(reader.stats())
+
+    def test():
+        class FakeSensor:
+            mask = 0
+
+            def KeyStatus(self):
+                return self.mask
 
-            time.sleep(0.5)
+        sensor = FakeSensor()
+        reader = KeypadReader(sensor, debounce=0.03, long_press=0.8,
+                              repeat=0.2)
+        # key 3 bounces on press, key 0 is held for a second
+        for t, mask in [(0.00, 0x8), (0.01, 0x0), (0.02, 0x8), (0.05, 0x9),
+                        (0.50, 0x1), (0.90, 0x1), (1.00, 0x1), (1.15, 0x1),
+                        (1.20, 0x0)]:
+            sensor.mask = mask
+            reader.Poll(t)
+        events = []
+        while not reader.events.empty():
+            e = reader.events.get()
+            events.append((e.kind, e.key, e.time))
+        print(events)
+        assert events == [
+            (EVENT_PRESS, 3, 0.00), (EVENT_PRESS, 0, 0.05),
+            (EVENT_RELEASE, 3, 0.50), (EVENT_LONG_PRESS, 0, 0.90),
+            (EVENT_REPEAT, 0, 1.15), (EVENT_RELEASE, 0, 1.20)]
+        print(reader.stats())
 
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        test()
+    else:
+        main()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Event driven main loop for menu style UIs
+
+The loop sleeps until an input source or a timer needs attention.
+Handlers return True if they changed the UI state and only then the
+`render` function (e.g. Menu.draw followed by a display's show) is
+called - at most `max_fps` times per second. When nothing happens
+the process does not wake up at all.
+
+Input helpers are hooked up like this:
+
+    loop = EventLoop(render)
+    # rotary_encoder.RotarySwitch: poll its MovementQueue
+    rotary = RotarySwitch(10, 8, queued=True, notify=loop.Wake)
+    loop.AddSource(lambda: rotary.events.Get(0), on_move)
+    # ttp229.KeypadReader: events are posted to the loop
+    keys = KeypadReader(SensorTTP229(), callback=loop.Callback(on_key))
+    # input.InputReader: poll a FrameQueue
+    frames = FrameQueue(notify=loop.Wake)
+    loop.AddSource(lambda: frames.Get(0), on_frames)
+    # timers
+    loop.AddTimer(60.0, on_minute)
+    loop.Run()
+
+Demo:
+./ui_loop.py
+"""
+
+import collections
+import heapq
+import logging
+import threading
+import time
+
+
+class Timer(object):
+
+    def __init__(self, due, period, handler, repeat):
+        self.due = due
+        self.period = period
+        self.handler = handler
+        self.repeat = repeat
+        self.cancelled = False
+
+    def Cancel(self):
+        self.cancelled = True
+
+
+class EventLoop(object):
+    """
+    `render`: called without arguments when the UI state changed
+    `max_fps`: upper bound for the render rate - input arriving faster
+        is handled but only the latest state is rendered
+
+    Handlers run on the thread calling Run. They return True when the
+    UI needs to be redrawn.
+    """
+
+    def __init__(self, render=None, max_fps=30.0):
+        self._render = render
+        self._min_frame = 1.0 / max_fps if max_fps else 0.0
+        self._wakeup = threading.Event()
+        self._posted = collections.deque()
+        self._sources = []
+        self._timers = []
+        self._seq = 0
+        # draw the initial state
+        self._dirty = True
+        self._running = False
+        self._last_render = 0.0
+        self._started = None
+        self._wakeups = 0
+        self._redraws = 0
+        self._skipped = 0
+        self._handler_time = 0.0
+        self._render_time = 0.0
+
+    def Wake(self):
+        """Wake up the loop to check its sources (thread safe)"""
+        self._wakeup.set()
+
+    def Post(self, handler, *args):
+        """Run `handler(*args)` on the loop thread (thread safe)"""
+        self._posted.append((handler, args))
+        self._wakeup.set()
+
+    def Callback(self, handler):
+        """Returns a function which can be used as a callback on any
+        thread and forwards its arguments to `handler` on the loop thread
+        """
+        return lambda *args: self.Post(handler, *args)
+
+    def AddSource(self, poll, handler):
+        """After each wakeup `poll()` is called and `handler(value)` if
+        it returned something. `poll` must not block. Producers must
+        call Wake when new data is available.
+        """
+        self._sources.append((poll, handler))
+
+    def AddTimer(self, period, handler, repeat=True):
+        """Call `handler()` after `period` secs (from the loop thread or
+        before Run, use Post otherwise)
+        """
+        timer = Timer(time.time() + period, period, handler, repeat)
+        self._seq += 1
+        heapq.heappush(self._timers, (timer.due, self._seq, timer))
+        return timer
+
+    def Invalidate(self):
+        """Force a redraw"""
+        self._dirty = True
+        self._wakeup.set()
+
+    def Stop(self):
+        self._running = False
+        self._wakeup.set()
+
+    def _Call(self, handler, *args):
+        start = time.time()
+        try:
+            if handler(*args):
+                self._dirty = True
+        except Exception:
+            logging.exception("ui handler failed")
+        self._handler_time += time.time() - start
+
+    def _Dispatch(self, now):
+        while self._posted:
+            handler, args = self._posted.popleft()
+            self._Call(handler, *args)
+        for poll, handler in self._sources:
+            value = poll()
+            if value:
+                self._Call(handler, value)
+        while self._timers and self._timers[0][0] <= now:
+            _, seq, timer = heapq.heappop(self._timers)
+            if timer.cancelled:
+                continue
+            self._Call(timer.handler)
+            if timer.repeat:
+                # keep the phase - do not drift
+                timer.due = max(timer.due + timer.period, now)
+                heapq.heappush(self._timers, (timer.due, seq, timer))
+
+    def _Timeout(self, now):
+        """secs until the loop needs to run again, None means forever"""
+        timeout = None
+        if self._timers:
+            timeout = max(0.0, self._timers[0][0] - now)
+        if self._dirty:
+            wait = max(0.0, self._last_render + self._min_frame - now)
+            timeout = wait if timeout is None else min(timeout, wait)
+        return timeout
+
+    def _Render(self, now):
+        self._dirty = False
+        self._last_render = now
+        self._redraws += 1
+        if self._render is None:
+            return
+        try:
+            self._render()
+        except Exception:
+            logging.exception("ui render failed")
+        self._render_time += time.time() - now
+
+    def Run(self):
+        self._running = True
+        self._started = time.time()
+        while self._running:
+            timeout = self._Timeout(time.time())
+            if timeout is None or timeout > 0:
+                self._wakeup.wait(timeout)
+            self._wakeup.clear()
+            self._wakeups += 1
+            now = time.time()
+            self._Dispatch(now)
+            if not self._dirty:
+                self._skipped += 1
+            elif now - self._last_render >= self._min_frame:
+                self._Render(now)
+            # else: rendered recently - _Timeout waits for the next slot
+
+    def stats(self):
+        elapsed = time.time() - self._started if self._started else 0.0
+        return {
+            "wakeups": self._wakeups,
+            "wakeups_per_sec": self._wakeups / elapsed if elapsed else 0.0,
+            "redraws": self._redraws,
+            "redraws_skipped": self._skipped,
+            "handler_time": self._handler_time,
+            "render_time": self._render_time,
+        }
+
+
+if __name__ == "__main__":
+    import os
+    import resource
+
+    from PIL import Image, ImageDraw, ImageFont
+
+    # the demo uses other helpers, the loop itself does not
+    import menu
+    import rotary_encoder
+
+    def main():
+        cwd = os.path.dirname(__file__)
+        w, h, font_h = 128, 64, 16
+        font = ImageFont.truetype(cwd + "/Fonts/code2000.ttf", font_h)
+        entries = ["%03d entry" % i for i in range(100)]
+        m = menu.MenuCentered(font, h // font_h - 1, w, font_h, entries,
+                              0, 32, 3)
+        image = Image.new("1", (w, h))
+        draw = ImageDraw.Draw(image)
+        state = {"active": 0, "shows": 0}
+
+        def render():
+            draw.rectangle((0, 0, w, h), "black")
+            m.draw(state["active"], draw)
+            # a display.show(image) would go here
+            state["shows"] += 1
+
+        def on_move(delta):
+            active = min(max(0, state["active"] + delta), len(entries) - 1)
+            if active == state["active"]:
+                return False
+            state["active"] = active
+            return True
+
+        loop = EventLoop(render)
+        # stands in for RotarySwitch(..., queued=True, notify=loop.Wake)
+        movement = rotary_encoder.MovementQueue(notify=loop.Wake)
+        loop.AddSource(lambda: movement.Get(0), on_move)
+
+        def spin():
+            # 300 detents/sec for 1 sec - many more than frames rendered
+            for i in range(300):
+                movement.Put(1)
+                time.sleep(1 / 300)
+            time.sleep(3.0)
+            loop.Post(loop.Stop)
+
+        threading.Thread(target=spin, daemon=True).start()
+        cpu = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.time()
+        loop.Run()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        print("active", state["active"], "shows", state["shows"])
+        print(loop.stats(), movement.stats())
+        print("cpu secs: %.3f over %.1f secs" %
+              (usage.ru_utime + usage.ru_stime - cpu.ru_utime - cpu.ru_stime,
+               time.time() - start))
+        assert state["active"] == 99
+        assert state["shows"] <= 40
+
+    main()